@@ -0,0 +1,406 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from multiprocessing.synchronize import Event
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fakes import SERVICE_HOSTS, ServiceConfig, serve  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ('single_link', 'multi_link', 'inline_storm', 'edit_before_forward')
+FORWARD_CHANNEL_ID = -1001234567890
+URL_PATTERN = re.compile(r'https?://\S+')
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q / 100 * (len(values) - 1)))]
+
+
+def rss() -> int:
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def max_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def git_revision() -> dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+class Links:
+    def __init__(self, providers: list[str], hot: float, seed: int):
+        self._providers: list[str] = providers
+        self._hot: float = hot
+        self._random: random.Random = random.Random(seed)
+        self._counter = itertools.count(1)
+        self._seen: list[str] = []
+
+    def __call__(self) -> str:
+        if self._seen and self._random.random() < self._hot:
+            return self._random.choice(self._seen)
+        n = next(self._counter)
+        match self._providers[n % len(self._providers)]:
+            case 'tweet':
+                url = f"https://x.com/user{n % 97}/status/{1800000000000000000 + n}"
+            case 'bsky':
+                url = f"https://bsky.app/profile/user{n % 97}.bsky.social/post/3k{n:011d}"
+            case _:
+                url = f"https://www.pixiv.net/artworks/{100000000 + n}"
+        self._seen.append(url)
+        return url
+
+
+class Bench:
+    def __init__(self, application, bot_api: str, links: Links):
+        self.application = application
+        self.bot_api: str = bot_api
+        self.links: Links = links
+        self.latencies: list[float] = []
+        self._pending: dict[int, tuple[float, asyncio.Future]] = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._client = httpx.AsyncClient(trust_env=False)
+
+    async def done(self, update, context) -> None:
+        # registered after every handler group, so it runs once the bot has finished with the update
+        if entry := self._pending.pop(update.update_id, None):
+            start, future = entry
+            self.latencies.append(time.perf_counter() - start)
+            future.set_result(None)
+
+    async def send(self, data: dict) -> None:
+        from telegram import Update
+
+        update_id = next(self._update_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update_id] = (time.perf_counter(), future)
+        await self.application.update_queue.put(Update.de_json({'update_id': update_id, **data}, self.application.bot))
+        await future
+
+    def message(self, chat_id: int, text: str, reply_to: int | None = None) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f'user{chat_id}'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            'text': text,
+            'entities': [
+                {'type': 'url', 'offset': match.start(), 'length': len(match.group())}
+                for match in URL_PATTERN.finditer(text)
+            ],
+        }
+        if reply_to is not None:
+            message['reply_to_message'] = self.bot_message(chat_id, reply_to)
+        return {'message': message}
+
+    def bot_message(self, chat_id: int, message_id: int) -> dict:
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f'user{chat_id}'},
+            'from': {'id': self.application.bot.id, 'is_bot': True, 'first_name': 'Bench'},
+            'text': "Reply to edit message.",
+        }
+
+    def inline_query(self, user_id: int, query: str) -> dict:
+        return {'inline_query': {
+            'id': str(next(self._message_ids)),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'query': query,
+            'offset': '',
+        }}
+
+    def callback_query(self, chat_id: int, message_id: int, data: str) -> dict:
+        return {'callback_query': {
+            'id': str(next(self._message_ids)),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            'chat_instance': str(chat_id),
+            'message': self.bot_message(chat_id, message_id),
+            'data': data,
+        }}
+
+    async def bot_stats(self) -> dict:
+        return (await self._client.get(f"{self.bot_api}/_stats")).json()
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+async def single_link(bench: Bench, chat_id: int, args: argparse.Namespace) -> None:
+    await bench.send(bench.message(chat_id, bench.links()))
+
+
+async def multi_link(bench: Bench, chat_id: int, args: argparse.Namespace) -> None:
+    await bench.send(bench.message(chat_id, "Look at these: " + " ".join(bench.links() for _ in range(args.links))))
+
+
+async def inline_storm(bench: Bench, chat_id: int, args: argparse.Namespace) -> None:
+    # a user typing or pasting a link produces several queries, each superseding the previous one
+    url = bench.links()
+    queries = []
+    for query in (url[:len(url) // 2], url[:-2], url):
+        queries.append(asyncio.create_task(bench.send(bench.inline_query(chat_id, query))))
+        await asyncio.sleep(args.keystroke_delay)
+    await asyncio.gather(*queries)
+
+
+async def edit_before_forward(bench: Bench, chat_id: int, args: argparse.Namespace) -> None:
+    chat_data = bench.application.chat_data[chat_id]
+    chat_data.forward_channel_id = FORWARD_CHANNEL_ID - chat_id  # each user forwards to a channel of their own
+    chat_data.edit_before_forward = True
+    message = bench.message(chat_id, bench.links())
+    await bench.send(message)
+    if not (prompt := (await bench.bot_stats())['prompts'].get(str(message['message']['message_id']))):
+        return  # the post failed, there is nothing to edit
+    await bench.send(bench.message(chat_id, "Edited caption", reply_to=prompt))
+    await bench.send(bench.callback_query(chat_id, prompt, 'forward'))
+
+
+SCENARIO_UNITS: dict[str, Callable[[Bench, int, argparse.Namespace], Awaitable[None]]] = {
+    'single_link': single_link,
+    'multi_link': multi_link,
+    'inline_storm': inline_storm,
+    'edit_before_forward': edit_before_forward,
+}
+
+
+def error_count() -> float:
+    from utils.metrics import ERRORS
+
+    return sum(sample.value for metric in ERRORS.collect() for sample in metric.samples
+               if sample.name.endswith('_total'))
+
+
+async def run_scenario(bench: Bench, name: str, args: argparse.Namespace, chats: range) -> dict[str, Any]:
+    unit = SCENARIO_UNITS[name]
+    bench.latencies = []
+    errors = error_count()
+    calls = (await bench.bot_stats())['calls']
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = rss()
+    start = time.perf_counter()
+    units = []
+    # open loop: units arrive at a fixed rate whether or not the bot keeps up
+    for i in range(args.units):
+        units.append(asyncio.create_task(unit(bench, chats[i % len(chats)], args)))
+        if args.rate:
+            await asyncio.sleep(max(0.0, start + (i + 1) / args.rate - time.perf_counter()))
+    results = await asyncio.gather(*units, return_exceptions=True)
+    duration = time.perf_counter() - start
+    calls_after = (await bench.bot_stats())['calls']
+    result = {
+        'units': args.units,
+        'updates': len(bench.latencies),
+        'failed_units': sum(isinstance(i, BaseException) for i in results),
+        'errors': int(error_count() - errors),
+        'duration': duration,
+        'throughput': len(bench.latencies) / duration,
+        'latency': {
+            'mean': sum(bench.latencies) / len(bench.latencies) if bench.latencies else 0.0,
+            'p50': percentile(bench.latencies, 50),
+            'p95': percentile(bench.latencies, 95),
+            'p99': percentile(bench.latencies, 99),
+            'max': max(bench.latencies, default=0.0),
+        },
+        'memory': {
+            'rss': rss(),
+            'rss_delta': rss() - rss_before,
+            'max_rss': max(max_rss(), rss()),
+        },
+        'bot_api_calls': {method: count - calls.get(method, 0) for method, count in calls_after.items()
+                          if count - calls.get(method, 0)},
+    }
+    if args.tracemalloc:
+        result['memory']['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+async def run(args: argparse.Namespace, urls: dict[str, str], inject: Event) -> dict[str, Any]:
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    import common
+    import main
+
+    providers = ['tweet', 'bsky'] + (['pixiv'] if common.PIXIV_REFRESH_TOKEN else [])
+    application = main.build_application()
+    bench = Bench(application, urls['bot'], Links(providers, args.hot, args.seed))
+    application.add_handler(TypeHandler(Update, bench.done), group=1)
+    results = {}
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        try:
+            # warm up connections and lazy imports before anything is measured
+            await run_scenario(bench, 'single_link', argparse.Namespace(**{**vars(args), 'units': 8}), range(1, 9))
+            inject.set()
+            for index, name in enumerate(args.scenarios):
+                # every scenario gets its own chats, so chat settings don't leak between them
+                chats = range((index + 1) * 10000, (index + 1) * 10000 + args.chats)
+                results[name] = await run_scenario(bench, name, args, chats)
+                report(name, results[name])
+        finally:
+            await bench.close()
+            await application.stop()
+            await application.post_stop(application)
+    await application.post_shutdown(application)
+    return results
+
+
+def report(name: str, result: dict[str, Any]) -> None:
+    latency = result['latency']
+    print(f"{name:<20} {result['updates']:>6} updates {result['throughput']:8.1f}/s  "
+          f"p50 {latency['p50'] * 1000:8.1f} ms  p95 {latency['p95'] * 1000:8.1f} ms  "
+          f"p99 {latency['p99'] * 1000:8.1f} ms  errors {result['errors']:>4}  "
+          f"rss {result['memory']['rss'] / 1024 / 1024:7.1f} MiB")
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any], threshold: float) -> bool:
+    # lower throughput or higher tail latency than the baseline by more than threshold is a regression
+    regressed = False
+    print(f"\ncompared with {baseline['commit'][:12]}:")
+    for name, result in current['scenarios'].items():
+        if not (base := baseline['scenarios'].get(name)):
+            continue
+        changes = {
+            'throughput': (result['throughput'], base['throughput'], -1),
+            'p95': (result['latency']['p95'], base['latency']['p95'], 1),
+            'p99': (result['latency']['p99'], base['latency']['p99'], 1),
+            'rss': (result['memory']['rss'], base['memory']['rss'], 1),
+        }
+        line = []
+        for metric, (value, before, direction) in changes.items():
+            change = (value - before) / before if before else 0.0
+            worse = change * direction > threshold
+            regressed |= worse and metric != 'rss'
+            line.append(f"{metric} {change:+7.1%}{' !' if worse else '  '}")
+        print(f"{name:<20} " + "  ".join(line))
+    return regressed
+
+
+def service_configs(args: argparse.Namespace) -> dict[str, ServiceConfig]:
+    configs = {
+        service: ServiceConfig(args.latency, args.jitter, args.error_rate, args.flood_rate if service == 'bot' else 0)
+        for service in SERVICE_HOSTS
+    }
+    for item in args.service_latency:
+        service, latency = item.split('=', 1)
+        configs[service].latency = float(latency)
+    return configs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the bot against local stand-ins of "
+                                                 "every upstream and the Bot API")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--units', type=int, default=200, help="interactions per scenario")
+    parser.add_argument('--rate', type=float, default=50, help="interactions started per second, 0 for all at once")
+    parser.add_argument('--chats', type=int, default=32)
+    parser.add_argument('--links', type=int, default=4, help="links per multi-link message")
+    parser.add_argument('--hot', type=float, default=0.2, help="share of links that repeat an earlier one")
+    parser.add_argument('--keystroke-delay', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.02, help="added to every stand-in response, seconds")
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--service-latency', nargs='*', default=[], metavar='SERVICE=SECONDS',
+                        help=f"per-service latency, services: {', '.join(SERVICE_HOSTS)}")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of stand-in responses that are 503")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="share of Bot API calls answered with 429")
+    parser.add_argument('--image-size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--no-pixiv', action='store_true')
+    parser.add_argument('--tracemalloc', action='store_true', help="also record the Python heap peak (slow)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="results file, default bench/results/<commit>.json")
+    parser.add_argument('--compare', help="results file of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    inject = context.Event()
+    fakes = context.Process(
+        target=serve,
+        args=(service_configs(args), tuple(args.image_size), inject, child),
+        daemon=True
+    )
+    fakes.start()
+    urls = parent.recv()
+
+    os.environ.update({
+        'WEBHOOK': 'false',
+        'BOT_TOKEN': '123456:bench',
+        'BOT_API_URL': f"{urls['bot']}/bot",
+        'BOT_API_FILE_URL': f"{urls['bot']}/file/bot",
+        'BOT_API_HTTP_VERSION': '1.1',
+        'NET_HOST_OVERRIDES': ",".join(f"{host}={urls[service]}" for service, hosts in SERVICE_HOSTS.items()
+                                       for host in hosts),
+        'METRICS_PORT': '0',
+        'TRACE_EXPORT': '',
+        'NO_PROXY': '127.0.0.1,localhost',
+    })
+    if args.no_pixiv:
+        os.environ.pop('PIXIV_REFRESH_TOKEN', None)
+    else:
+        os.environ['PIXIV_REFRESH_TOKEN'] = 'bench-refresh-token'
+
+    output = Path(args.output).resolve() if args.output else None
+    baseline = Path(args.compare).resolve() if args.compare else None
+    revision = git_revision()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)  # persistence, caches and rendered media all live under data/
+            scenarios = asyncio.run(run(args, urls, inject))
+            os.chdir(ROOT)
+    finally:
+        parent.send(None)
+        fakes.join(5)
+
+    current = {
+        **revision,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': scenarios,
+    }
+    output = output or ROOT / 'bench' / 'results' / f"{revision['commit'][:12] or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(current, indent=2))
+    print(f"results written to {output}")
+    if baseline and compare(json.loads(baseline.read_text()), current, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
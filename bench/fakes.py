@@ -0,0 +1,370 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from multiprocessing.synchronize import Event
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+# upstream host -> stand-in service; NET_HOST_OVERRIDES is built from this
+SERVICE_HOSTS = {
+    'vx': ['api.vxtwitter.com'],
+    'fx': ['api.fxtwitter.com'],
+    'bsky': ['public.api.bsky.app'],
+    'pixiv': ['app-api.pixiv.net', 'oauth.secure.pixiv.net'],
+    'media': ['pbs.twimg.com', 'video.twimg.com', 'cdn.bsky.app', 'video.bsky.app', 'i.pximg.net'],
+    'bot': [],
+}
+
+
+@dataclass
+class ServiceConfig:
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    flood_rate: float = 0.0  # Bot API only: answer 429 with retry_after
+
+
+# errors are only injected while set, so the bot can start up cleanly
+injecting: Event | None = None
+
+
+def make_image(width: int, height: int) -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_noise((width, height), 32).convert('RGB').save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def post_number(post_id: str) -> int:
+    return int(re.sub(r'\D', '', post_id) or 0)
+
+
+def media_count(post_id: str) -> int:
+    return post_number(post_id) % 4 + 1
+
+
+class FakeHandler(RequestHandler):
+    config: ServiceConfig
+
+    def initialize(self, config: ServiceConfig, **kwargs):
+        self.config = config
+
+    async def prepare(self):
+        delay = self.config.latency + random.uniform(0, self.config.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if injecting.is_set() and random.random() < self.config.error_rate:
+            self.send_error(503)
+
+    def write_json(self, data) -> None:
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(data))
+
+
+class VxHandler(FakeHandler):
+    def get(self, user: str, tweet_id: str):
+        self.write_json({
+            'tweetID': tweet_id,
+            'user_name': user.title(),
+            'user_screen_name': user,
+            'text': f"Benchmark tweet {tweet_id} https://t.co/{tweet_id}",
+            'media_extended': tweet_media(tweet_id),
+            'possibly_sensitive': False,
+        })
+
+
+class FxHandler(FakeHandler):
+    def get(self, user: str, tweet_id: str):
+        self.write_json({'tweet': {
+            'id': tweet_id,
+            'text': f"Benchmark tweet {tweet_id}",
+            'author': {'name': user.title(), 'screen_name': user},
+            'media': {'all': [
+                {'type': 'photo' if media['type'] == 'image' else media['type'], 'url': media['url'],
+                 'thumbnail_url': media['thumbnail_url']}
+                for media in tweet_media(tweet_id)
+            ]},
+            'possibly_sensitive': False,
+        }})
+
+
+def tweet_media(tweet_id: str) -> list[dict]:
+    if post_number(tweet_id) % 5 == 0:
+        return [{
+            'type': 'video',
+            'url': f'https://video.twimg.com/ext_tw_video/{tweet_id}/pu/vid/1280x720/{tweet_id}.mp4',
+            'thumbnail_url': f'https://pbs.twimg.com/ext_tw_video_thumb/{tweet_id}/pu/img/{tweet_id}.jpg',
+        }]
+    return [
+        {
+            'type': 'image',
+            'url': f'https://pbs.twimg.com/media/{tweet_id}_{i}.jpg',
+            'thumbnail_url': f'https://pbs.twimg.com/media/{tweet_id}_{i}.jpg',
+        }
+        for i in range(media_count(tweet_id))
+    ]
+
+
+class BskyHandler(FakeHandler):
+    def get(self):
+        _, handle, _, post_id = self.get_query_argument('uri').rsplit('/', 3)
+        self.write_json({'thread': {'post': {
+            'author': {'handle': handle, 'displayName': handle.split('.')[0].title()},
+            'record': {'text': f"Benchmark post {post_id}"},
+            'embed': {
+                '$type': 'app.bsky.embed.images#view',
+                'images': [
+                    {
+                        'thumb': f'https://cdn.bsky.app/img/feed_thumbnail/plain/{handle}/{post_id}_{i}@jpeg',
+                        'fullsize': f'https://cdn.bsky.app/img/feed_fullsize/plain/{handle}/{post_id}_{i}@jpeg',
+                    }
+                    for i in range(media_count(post_id))
+                ],
+            },
+            'labels': [],
+        }}})
+
+
+def pixiv_user(user_id: int) -> dict:
+    return {
+        'id': user_id,
+        'name': f'artist{user_id}',
+        'account': f'artist{user_id}',
+        'profile_image_urls': {'medium': f'https://i.pximg.net/user-profile/img/{user_id}_170.jpg'},
+        'is_followed': False,
+    }
+
+
+class PixivTokenHandler(FakeHandler):
+    def post(self):
+        self.write_json({
+            'access_token': 'bench-access-token',
+            'refresh_token': 'bench-refresh-token',
+            'expires_in': 3600,
+            'user': {
+                **pixiv_user(1),
+                'profile_image_urls': {'px_170x170': 'https://i.pximg.net/user-profile/img/1_170.jpg'},
+                'is_premium': False,
+                'x_restrict': 2,
+                'is_mail_authorized': True,
+                'require_policy_agreement': False,
+            },
+        })
+
+
+class PixivIllustHandler(FakeHandler):
+    def get(self):
+        illust_id = int(self.get_query_argument('illust_id'))
+        pages = [
+            {
+                'square_medium': f'https://i.pximg.net/c/360x360_70/img-master/img/{illust_id}_p{i}_square1200.jpg',
+                'medium': f'https://i.pximg.net/c/540x540_70/img-master/img/{illust_id}_p{i}_master1200.jpg',
+                'large': f'https://i.pximg.net/c/600x1200_90/img-master/img/{illust_id}_p{i}_master1200.jpg',
+                'original': f'https://i.pximg.net/img-original/img/{illust_id}_p{i}.jpg',
+            }
+            for i in range(media_count(str(illust_id)))
+        ]
+        self.write_json({'illust': {
+            'id': illust_id,
+            'title': f'Benchmark {illust_id}',
+            'type': 'illust',
+            'image_urls': {key: value for key, value in pages[0].items() if key != 'original'},
+            'caption': '',
+            'restrict': 0,
+            'user': pixiv_user(illust_id % 1000),
+            'tags': [{'name': 'benchmark', 'translated_name': None}],
+            'tools': [],
+            'create_date': '2024-01-01T00:00:00+09:00',
+            'page_count': len(pages),
+            'width': 1280,
+            'height': 720,
+            'sanity_level': 2,
+            'x_restrict': 0,
+            'meta_single_page': {'original_image_url': pages[0]['original']} if len(pages) == 1 else {},
+            'meta_pages': [{'image_urls': page} for page in pages] if len(pages) > 1 else [],
+            'total_view': 0,
+            'total_bookmarks': 0,
+            'is_bookmarked': False,
+            'visible': True,
+            'is_muted': False,
+            'illust_ai_type': 1,
+            'illust_book_style': 0,
+        }})
+
+
+class MediaHandler(FakeHandler):
+    image: bytes
+
+    def initialize(self, config: ServiceConfig, image: bytes = b''):
+        super().initialize(config)
+        self.image = image
+
+    def head(self, path: str):
+        self.set_header('Content-Length', str(len(self.image)))
+        self.finish()
+
+    def get(self, path: str):
+        self.set_header('Content-Type', 'video/mp4' if path.endswith('.mp4') else 'image/jpeg')
+        self.set_header('Accept-Ranges', 'bytes')
+        if match := re.fullmatch(r'bytes=(\d+)-(\d*)', self.request.headers.get('Range', '')):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(self.image) - 1), len(self.image) - 1)
+            self.set_status(206)
+            self.set_header('Content-Range', f'bytes {start}-{end}/{len(self.image)}')
+            self.finish(self.image[start:end + 1])
+            return
+        self.finish(self.image)
+
+
+def reply_to_message_id(params: dict) -> int | None:
+    if 'reply_parameters' in params:
+        return json.loads(params['reply_parameters'])['message_id']
+    return int(params['reply_to_message_id']) if 'reply_to_message_id' in params else None
+
+
+class BotApi:
+    me = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot', 'can_join_groups': True,
+          'can_read_all_group_messages': False, 'supports_inline_queries': True}
+
+    def __init__(self):
+        self.calls: Counter[str] = Counter()
+        self.prompts: dict[int, int] = {}  # message replied to -> reply sent with an inline keyboard
+        self._message_id = 0
+
+    def message(self, chat_id: int, **content) -> dict:
+        self._message_id += 1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+            'from': self.me,
+            **content,
+        }
+
+    def media(self, item: dict) -> dict:
+        file = {'file_id': f'bench-{self._message_id + 1}', 'file_unique_id': f'u{self._message_id + 1}'}
+        match item.get('type'):
+            case 'photo':
+                return {'photo': [{**file, 'width': 1280, 'height': 720}]}
+            case 'video':
+                return {'video': {**file, 'width': 1280, 'height': 720, 'duration': 10}}
+            case 'animation':
+                return {'animation': {**file, 'width': 1280, 'height': 720, 'duration': 5}}
+        return {'document': file}
+
+    def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        chat_id = int(params.get('chat_id', 0) or 0)
+        match method:
+            case 'getMe':
+                return self.me
+            case 'getChat':
+                return {'id': chat_id, 'type': 'channel', 'title': 'Bench'}
+            case 'sendMediaGroup':
+                return [self.message(chat_id, **self.media(item)) for item in json.loads(params['media'])]
+            case 'sendPhoto' | 'sendVideo' | 'sendAnimation' | 'sendDocument':
+                return self.message(chat_id, **self.media({'type': method.removeprefix('send').lower()}))
+            case 'sendMessage':
+                message = self.message(chat_id, text=params.get('text', ''))
+                if 'reply_markup' in params and (reply_to := reply_to_message_id(params)):
+                    self.prompts[reply_to] = message['message_id']
+                return message
+            case 'editMessageCaption':
+                return self.message(chat_id, caption=params.get('caption', ''))
+            case 'copyMessages':
+                return [{'message_id': self.message(chat_id)['message_id']} for _ in json.loads(params['message_ids'])]
+        return True
+
+
+class BotApiHandler(FakeHandler):
+    api: BotApi
+
+    def initialize(self, config: ServiceConfig, api: BotApi = None):
+        super().initialize(config)
+        self.api = api
+
+    async def prepare(self):
+        await super().prepare()
+        if not self._finished and injecting.is_set() and random.random() < self.config.flood_rate:
+            self.set_status(429)
+            self.write_json({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                             'parameters': {'retry_after': 1}})
+
+    def write_error(self, status_code: int, **kwargs):
+        self.write_json({'ok': False, 'error_code': status_code, 'description': self._reason})
+
+    def params(self) -> dict:
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(self.request.body or b'{}')
+        return {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+
+    def post(self, token: str, method: str):
+        self.write_json({'ok': True, 'result': self.api.call(method, self.params())})
+
+    get = post
+
+
+class StatsHandler(RequestHandler):
+    def initialize(self, api: BotApi):
+        self.api = api
+
+    def get(self):
+        self.finish({'calls': dict(self.api.calls), 'prompts': {str(k): v for k, v in self.api.prompts.items()}})
+
+
+def routes(service: str, config: ServiceConfig, image: bytes, api: BotApi) -> list:
+    kwargs = {'config': config}
+    match service:
+        case 'vx' | 'fx':
+            return [(r'/([^/]+)/status/(\d+)', VxHandler if service == 'vx' else FxHandler, kwargs)]
+        case 'bsky':
+            return [(r'/xrpc/app\.bsky\.feed\.getPostThread', BskyHandler, kwargs)]
+        case 'pixiv':
+            return [
+                (r'/auth/token', PixivTokenHandler, kwargs),
+                (r'/v1/illust/detail', PixivIllustHandler, kwargs),
+            ]
+        case 'media':
+            return [(r'/(.*)', MediaHandler, {**kwargs, 'image': image})]
+        case 'bot':
+            return [
+                (r'/_stats', StatsHandler, {'api': api}),
+                (r'/(?:file/)?bot([^/]+)/(\w+)', BotApiHandler, {**kwargs, 'api': api}),
+            ]
+    raise ValueError(f"Unknown service {service}")
+
+
+async def start(configs: dict[str, ServiceConfig], image_size: tuple[int, int]) -> dict[str, str]:
+    image = make_image(*image_size)
+    api = BotApi()
+    urls = {}
+    for service in SERVICE_HOSTS:
+        sockets = bind_sockets(0, '127.0.0.1')
+        HTTPServer(Application(routes(service, configs.get(service, ServiceConfig()), image, api))).add_sockets(sockets)
+        urls[service] = f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+    return urls
+
+
+def serve(configs: dict[str, ServiceConfig], image_size: tuple[int, int], inject: Event, conn: Connection) -> None:
+    # runs in its own process so the stand-ins don't compete with the bot for the event loop
+    global injecting
+    injecting = inject
+    logging.getLogger('tornado.access').disabled = True
+
+    async def run():
+        conn.send(await start(configs, image_size))
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("WEBHOOK", "false")
+
+from PIL import Image  # noqa: E402
+
+from utils.transcode import shrink_image  # noqa: E402
+from utils.variant import PHOTO_MAX_DIMENSIONS, PHOTO_MAX_SIZE  # noqa: E402
+
+
+def make_image(path: str, width: int, height: int) -> None:
+    # noise keeps the JPEG large, like a detailed illustration
+    Image.effect_noise((width, height), 64).convert('RGB').save(path, 'JPEG', quality=95)
+
+
+def run(sources: list[str], output: str, workers: int) -> float:
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        list(pool.map(int, range(workers)))  # start every worker before timing
+        start = time.perf_counter()
+        list(pool.map(
+            shrink_image,
+            sources,
+            [os.path.join(output, f'{i}.jpg') for i in range(len(sources))],
+            [PHOTO_MAX_SIZE] * len(sources),
+            [PHOTO_MAX_DIMENSIONS] * len(sources),
+        ))
+        return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Throughput of oversize image shrinking per worker count")
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--width', type=int, default=8000)
+    parser.add_argument('--height', type=int, default=6000)
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.jpg')
+        make_image(source, args.width, args.height)
+        print(f"source: {args.width}x{args.height}, {os.path.getsize(source) / 1024 / 1024:.1f} MiB")
+        for workers in args.workers:
+            elapsed = run([source] * args.images, tmp, workers)
+            print(f"workers={workers:<3} {args.images / elapsed:6.2f} images/s  "
+                  f"{elapsed / args.images * 1000:7.1f} ms/image")
+
+
+if __name__ == '__main__':
+    main()
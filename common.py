@@ -9,9 +9,93 @@ except ImportError:
     uvloop = None
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL", "https://api.telegram.org/file/bot")
+BOT_API_HTTP_VERSION = os.getenv("BOT_API_HTTP_VERSION", "2")  # 1.1 for a plain http local Bot API server
 ADMIN = [int(i) for i in os.getenv("BOT_ADMIN", "").split(",") if i]
 
 PIXIV_REFRESH_TOKEN = os.getenv("PIXIV_REFRESH_TOKEN")
+PIXIV_REFRESH_INTERVAL = float(os.getenv("PIXIV_REFRESH_INTERVAL", 2700))
+PIXIV_RETRY_ATTEMPTS = int(os.getenv("PIXIV_RETRY_ATTEMPTS", 3))
+PIXIV_TIMEOUT = float(os.getenv("PIXIV_TIMEOUT", 10))
+
+POST_CACHE_TTL = float(os.getenv("POST_CACHE_TTL", 600))
+POST_CACHE_SIZE = int(os.getenv("POST_CACHE_SIZE", 1024))
+POST_CACHE_DB = os.getenv("POST_CACHE_DB", "data/post_cache.sqlite")  # shared by the workers
+
+FILE_ID_DB = os.getenv("FILE_ID_DB", "data/file_id.sqlite")
+
+MESSAGE_CONCURRENCY = int(os.getenv("MESSAGE_CONCURRENCY", 4))
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+UPDATE_CHAT_CONCURRENCY = int(os.getenv("UPDATE_CHAT_CONCURRENCY", 2))
+UPDATE_FAST_CONCURRENCY = int(os.getenv("UPDATE_FAST_CONCURRENCY", 64))  # inline and callback queries
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1024))
+UPDATE_CHAT_QUEUE_SIZE = int(os.getenv("UPDATE_CHAT_QUEUE_SIZE", 50))
+UPDATE_BUSY_DEPTH = int(os.getenv("UPDATE_BUSY_DEPTH", 5))  # tell the chat it is queued at this depth
+
+# Bot API flood limits, in messages; a media group counts once per item
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))  # per second
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # per second, private chats
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 10))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 20 / 60))  # per second, groups and channels
+SEND_GROUP_BURST = int(os.getenv("SEND_GROUP_BURST", 20))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))  # RetryAfter retries per call
+FORWARD_BATCH_WINDOW = float(os.getenv("FORWARD_BATCH_WINDOW", 0.5))  # seconds copies to a channel wait to batch
+FORWARD_BATCH_SIZE = min(100, int(os.getenv("FORWARD_BATCH_SIZE", 100)))  # copy_messages takes at most 100 ids
+
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.3))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))
+
+EDIT_MESSAGE_TTL = float(os.getenv("EDIT_MESSAGE_TTL", 86400))
+EDIT_MESSAGE_SIZE = int(os.getenv("EDIT_MESSAGE_SIZE", 32))
+
+NET_MAX_CONNECTIONS = int(os.getenv("NET_MAX_CONNECTIONS", 100))
+NET_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("NET_MAX_KEEPALIVE_CONNECTIONS", 20))
+NET_MAX_HOST_CONNECTIONS = int(os.getenv("NET_MAX_HOST_CONNECTIONS", 16))
+NET_KEEPALIVE_EXPIRY = float(os.getenv("NET_KEEPALIVE_EXPIRY", 120))
+NET_CONNECT_TIMEOUT = float(os.getenv("NET_CONNECT_TIMEOUT", 5))
+NET_READ_TIMEOUT = float(os.getenv("NET_READ_TIMEOUT", 10))
+NET_WRITE_TIMEOUT = float(os.getenv("NET_WRITE_TIMEOUT", 10))
+NET_POOL_TIMEOUT = float(os.getenv("NET_POOL_TIMEOUT", 5))
+NET_RETRY_ATTEMPTS = int(os.getenv("NET_RETRY_ATTEMPTS", 3))
+NET_RETRY_BACKOFF = float(os.getenv("NET_RETRY_BACKOFF", 0.2))
+NET_RETRY_MAX_BACKOFF = float(os.getenv("NET_RETRY_MAX_BACKOFF", 5))
+NET_BREAKER_THRESHOLD = int(os.getenv("NET_BREAKER_THRESHOLD", 5))
+NET_BREAKER_COOLDOWN = float(os.getenv("NET_BREAKER_COOLDOWN", 30))
+NET_WARM_UP_HOSTS = [i for i in os.getenv(
+    "NET_WARM_UP_HOSTS", "api.vxtwitter.com,api.fxtwitter.com,public.api.bsky.app,pbs.twimg.com,video.twimg.com"
+).split(",") if i]
+
+# host=scheme://host:port pairs, to point upstream hosts at local stand-ins (see bench/e2e.py)
+NET_HOST_OVERRIDES = dict(i.split("=", 1) for i in os.getenv("NET_HOST_OVERRIDES", "").split(",") if i)
+NET_REPLAY_MODE = os.getenv("NET_REPLAY_MODE", "").lower()  # "", "record" or "replay"
+NET_REPLAY_DB = os.getenv("NET_REPLAY_DB", "data/replay.sqlite")
+NET_REPLAY_SPEED = float(os.getenv("NET_REPLAY_SPEED", 1))  # 2 replays twice as fast, 0 without delays
+
+TWEET_HEDGE_DELAY = float(os.getenv("TWEET_HEDGE_DELAY", 2))
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "data/media_cache")
+MEDIA_CACHE_DB = os.getenv("MEDIA_CACHE_DB", "data/media_cache.sqlite")
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", 1 << 30))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+TRANSCODE_QUEUE = int(os.getenv("TRANSCODE_QUEUE", 8))
+HLS_WINDOW = int(os.getenv("HLS_WINDOW", 4))
+
+VARIANT_CACHE_TTL = int(os.getenv("VARIANT_CACHE_TTL", 86400))
+VARIANT_CACHE_SIZE = int(os.getenv("VARIANT_CACHE_SIZE", 4096))
+
+UPLOAD_ROUTE_TTL = int(os.getenv("UPLOAD_ROUTE_TTL", 86400))
+UPLOAD_ROUTE_SIZE = int(os.getenv("UPLOAD_ROUTE_SIZE", 4096))
+UPLOAD_HOST_THRESHOLD = int(os.getenv("UPLOAD_HOST_THRESHOLD", 5))
+UPLOAD_HOST_TTL = int(os.getenv("UPLOAD_HOST_TTL", 3600))  # then the host gets another try with urls
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # 0 disables the metrics endpoint, workers use the next ports
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").lower()  # "", "jsonl" or "otlp"
+TRACE_FILE = os.getenv("TRACE_FILE", "data/trace.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
 
 WEBHOOK = os.getenv("WEBHOOK").strip().lower() in ("true", "yes", "1")
 if WEBHOOK:
@@ -21,3 +105,12 @@ if WEBHOOK:
     WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "cert/private.key")
     WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "cert/cert.pem")
     WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+
+# webhook updates are sharded by chat over this many processes, see utils/shard.py
+WORKERS = int(os.getenv("WORKERS", 1)) if WEBHOOK else 1
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))  # set by the front for each worker
+# acknowledge webhook updates once they are stored, workers then take them from the queue
+WEBHOOK_QUEUE = WEBHOOK and os.getenv("WEBHOOK_QUEUE", "").strip().lower() in ("true", "yes", "1")
+WEBHOOK_QUEUE_DB = os.getenv("WEBHOOK_QUEUE_DB", "data/webhook_queue.sqlite")
+WEBHOOK_QUEUE_RETENTION = float(os.getenv("WEBHOOK_QUEUE_RETENTION", 86400))  # seconds handled updates are kept
+WEBHOOK_QUEUE_INFLIGHT = int(os.getenv("WEBHOOK_QUEUE_INFLIGHT", 256))  # updates a worker takes at a time
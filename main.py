@@ -1,28 +1,49 @@
 from __future__ import annotations
 
+import asyncio
 import html
+import socket
 from functools import wraps
-from typing import TYPE_CHECKING
+from typing import Sequence, TYPE_CHECKING
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
 from telegram.constants import ChatAction, ChatType, ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes, Defaults,
-                          InlineQueryHandler, MessageHandler, PicklePersistence, filters)
+                          InlineQueryHandler, MessageHandler, PersistenceInput, filters)
 
 import common
 import utils.regex as regex
+from utils.cache import PostCache
 from utils.context import ChatData, CustomContext, EditMessage
+from utils.fileid import FileIdCache
+from utils.forward import ForwardBatch
 from utils.logger import get_logger
+from utils.media import MediaCache
+from utils.metrics import MetricsRequest, count_error, measure_handler, start_metrics_server
 from utils.net import NetClient
+from utils.persistence import SQLitePersistence
 from utils.pixiv import ProcessPixiv
+from utils.ratelimit import SendLimiter
+from utils.replay import ReplayStore
+from utils.scheduler import UpdateScheduler
+from utils.shard import serve_front, serve_worker
 from utils.telegram import Telegram
+from utils.trace import Tracer, span, trace_handler
+from utils.transcode import Transcoder
+from utils.upload import MediaUpload, UploadRoute, is_fetch_error, is_file_id_error, remote_urls
 
 if TYPE_CHECKING:
     from telegram import Message, Update
     from telegram.ext import Application
 
+    from utils.telegram import TelegramBsky, TelegramPixiv, TelegramTweet
+    from utils.types import TypeMessageMediaResult
+
 logger = get_logger(__name__)
 
+inline_query_tasks: dict[int, asyncio.Task] = {}
+
 
 def send_action(action):
     def decorator(func):
@@ -38,50 +59,111 @@ def send_action(action):
     return decorator
 
 
-def extract_urls(message: Message) -> set[str]:
+def extract_urls(message: Message) -> list[str]:
     types = [MessageEntity.URL, MessageEntity.TEXT_LINK]
     res = message.parse_entities(types)
     res.update(message.parse_caption_entities(types))
     res.update({key: key.url for key in res if key.type == MessageEntity.TEXT_LINK})
-    return set(res.values())
+    return list(dict.fromkeys(res[key] for key in sorted(res, key=lambda entity: entity.offset)))
+
+
+async def resolve_url(
+        url: str,
+        refresh: bool = False,
+        prepare_media: bool = True
+) -> TelegramTweet | TelegramPixiv | TelegramBsky | None:
+    async with Telegram(url, refresh, prepare_media) as tweet:
+        return tweet
+
+
+async def resolve_inline_query(query: str) -> TelegramTweet | TelegramPixiv | TelegramBsky | None:
+    await asyncio.sleep(common.INLINE_DEBOUNCE)
+    return await resolve_url(query, prepare_media=False)
 
 
 async def inline_query(update: Update, context: CustomContext) -> None:
     query = update.inline_query.query
     if query == "":
         return
-    logger.info(f"Query: {query}")
-    async with Telegram(query) as tweet:
-        if not tweet:
-            return
-        await update.inline_query.answer(tweet.inline_query_result())
+    logger.info("Query: %s", query)
+    user_id = update.inline_query.from_user.id
+    if previous := inline_query_tasks.get(user_id):
+        previous.cancel()
+    inline_query_tasks[user_id] = task = asyncio.create_task(resolve_inline_query(query))
+    try:
+        tweet = await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        logger.debug("Query superseded: %s", query)
+        return
+    finally:
+        if inline_query_tasks.get(user_id) is task:
+            del inline_query_tasks[user_id]
+    if not tweet:
+        return
+    await update.inline_query.answer(
+        tweet.inline_query_result(),
+        cache_time=common.INLINE_CACHE_TIME,
+        is_personal=False,
+    )
 
 
 @send_action(ChatAction.UPLOAD_PHOTO)
-async def url_media(update: Update, context: CustomContext, url: str) -> None:
-    async with Telegram(url) as tweet:
-        if not tweet:
-            return
-        media = tweet.message_media_result()
-        if not media:
-            await update.effective_message.reply_text(
-                "No media found or media type is not supported.",
-                reply_to_message_id=update.message.message_id,
-            )
-            return
-        message_to_send = await update.effective_message.reply_media_group(
-            media,
-            caption=tweet.message_text,
-            reply_to_message_id=update.message.message_id,
-        ) if not isinstance(media[0], tuple) else await update.effective_message.reply_animation(
-            media[0][0],
-            caption=tweet.message_text,
+async def url_media(update: Update, context: CustomContext, url: str, refresh: bool = False) -> None:
+    with span('resolve', url=url):
+        tweet = await resolve_url(url, refresh)
+    await send_media(update, context, tweet)
+
+
+@send_action(ChatAction.UPLOAD_PHOTO)
+async def urls_media(update: Update, context: CustomContext, urls: list[str]) -> None:
+    semaphore = asyncio.Semaphore(common.MESSAGE_CONCURRENCY)
+
+    async def resolve(url: str) -> TelegramTweet | TelegramPixiv | TelegramBsky | None:
+        async with semaphore:
+            with span('resolve', url=url):
+                return await resolve_url(url)
+
+    tasks = [asyncio.create_task(resolve(url)) for url in urls]
+    try:
+        for url, task in zip(urls, tasks):
+            try:
+                await send_media(update, context, await task)
+            except Exception as e:
+                logger.warning("Failed to process %s: %r", url, e)
+                count_error(e)
+                await update.effective_message.reply_text(
+                    f"{html.escape(url)}\n{html.escape(str(e))}",
+                    reply_to_message_id=update.message.message_id,
+                    disable_web_page_preview=True,
+                )
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def send_media(
+        update: Update,
+        context: CustomContext,
+        tweet: TelegramTweet | TelegramPixiv | TelegramBsky | None
+) -> None:
+    if not tweet:
+        return
+    media = tweet.message_media_result()
+    if not media:
+        await update.effective_message.reply_text(
+            "No media found or media type is not supported.",
             reply_to_message_id=update.message.message_id,
-            has_spoiler=media[0][1]
         )
-        if not isinstance(message_to_send, tuple):
-            message_to_send = (message_to_send,)
-        url = tweet.url
+        return
+    with span('send', url=tweet.url):
+        message_to_send = await reply_media(update, tweet, media, tweet.message_text)
+    if context.chat_data.send_original and (documents := tweet.original_documents()):
+        with span('send_original', url=tweet.url):
+            # the Bot API fetches only GIF, PDF and ZIP documents by url, so images go up as files
+            await reply_media(update, tweet, documents, upload_urls=True)
+    url = tweet.url
     if context.chat_data.edit_before_forward:
         message_reply = await update.effective_message.reply_text(
             "Reply to edit message.",
@@ -91,30 +173,87 @@ async def url_media(update: Update, context: CustomContext, url: str) -> None:
             ),
             reply_to_message_id=update.message.message_id,
         )
-        context.chat_data.edit_message[message_reply.id] = EditMessage(
-            url=url,
-            forward=message_to_send
-        )
+        context.chat_data.add_edit_message(message_reply.id, EditMessage(
+            chat_id=update.effective_chat.id,
+            message_ids=tuple(m.id for m in message_to_send),
+            url=url
+        ))
         return
     if context.chat_data.forward_channel_id:
-        await forward_message(update, context, message_to_send)
+        with span('forward', url=url):
+            await forward_message(update, context, [m.id for m in message_to_send])
+
+
+async def reply_media(
+        update: Update,
+        tweet: TelegramTweet | TelegramPixiv | TelegramBsky,
+        media: Sequence[TypeMessageMediaResult],
+        caption: str | None = None,
+        upload_urls: bool = False
+) -> tuple[Message, ...]:
+    with MediaUpload() as upload:
+        media = await upload.prepare(media, upload_urls=upload_urls)
+        uploaded = upload_urls  # sends that never tried the urls tell UploadRoute nothing
+        while True:
+            try:
+                messages = await reply_media_once(update, media, caption)
+                break
+            except BadRequest as e:
+                if ((is_fetch_error(e) or is_file_id_error(e))
+                        and (restored := FileIdCache.forget(media)) is not None):
+                    # a stale cached file_id fails like a bad url, so try the original urls before uploading
+                    logger.info("Telegram rejected cached file_ids for %s, sending urls instead: %s", tweet.url,
+                                e.message)
+                    media = await upload.prepare(restored, upload_urls=upload_urls)
+                    continue
+                if uploaded or not is_fetch_error(e) or not (urls := remote_urls(media)):
+                    raise
+                logger.info("Telegram failed to fetch %s, uploading it instead: %s", tweet.url, e.message)
+                UploadRoute.failed(urls)
+                media = await upload.prepare(media, upload_urls=True)
+                uploaded = True
+        if not uploaded:
+            UploadRoute.succeeded(remote_urls(media))
+    FileIdCache.record(media, messages)
+    return messages
+
+
+async def reply_media_once(
+        update: Update,
+        media: Sequence[TypeMessageMediaResult],
+        caption: str | None = None
+) -> tuple[Message, ...]:
+    if isinstance(media[0], tuple):
+        return (await update.effective_message.reply_animation(
+            media[0][0],
+            caption=caption,
+            reply_to_message_id=update.message.message_id,
+            has_spoiler=media[0][1]
+        ),)
+    return await update.effective_message.reply_media_group(
+        media,
+        caption=caption,
+        reply_to_message_id=update.message.message_id,
+    )
 
 
 async def handel_url_media(update: Update, context: CustomContext) -> None:
-    url = update.message.text
-    logger.info(f"Receiving url: {url}")
-    await url_media(update, context, url)
+    urls = extract_urls(update.message) or [update.message.text]
+    logger.info("Receiving urls: %s", urls)
+    await urls_media(update, context, urls)
 
 
 async def forward_message(
         update: Update,
         context: CustomContext,
-        message_to_send: tuple[Message, ...],
+        message_ids: Sequence[int],
 ) -> None:
     try:
-        await update.effective_chat.copy_messages(
+        await ForwardBatch.copy(
+            context.bot,
+            update.effective_chat.id,
             context.chat_data.forward_channel_id,
-            [m.id for m in message_to_send]
+            message_ids
         )
     except Exception as e:
         await update.effective_message.reply_text(str(e))
@@ -123,7 +262,7 @@ async def forward_message(
 async def edit_message(update: Update, context: CustomContext) -> bool:
     if not (reply := update.message.reply_to_message):
         return False
-    _edit_message = context.chat_data.edit_message.get(reply.id, None)
+    _edit_message = context.chat_data.edit_message.get(reply.id)
     if not _edit_message:
         return False
     new_text = '<a href="{0}">{1}</a>'.format(
@@ -132,7 +271,11 @@ async def edit_message(update: Update, context: CustomContext) -> bool:
     )
     update_text = context.chat_data.template[template].replace("[]", new_text) if (
         template := _edit_message.template) else new_text
-    await _edit_message.forward[0].edit_caption(update_text)
+    await context.bot.edit_message_caption(
+        chat_id=_edit_message.chat_id,
+        message_id=_edit_message.message_ids[0],
+        caption=update_text
+    )
     return True
 
 
@@ -141,25 +284,35 @@ async def handle_message(update: Update, context: CustomContext) -> None:
         return
     if not (urls := extract_urls(update.message)):
         return
-    for url in urls:
-        await url_media(update, context, url)
+    await urls_media(update, context, urls)
 
 
 async def query_forward_message(update: Update, context: CustomContext) -> None:
-    _edit_message = context.chat_data.edit_message[update.effective_message.id]
-    await forward_message(update, context, _edit_message.forward)
+    _edit_message = context.chat_data.edit_message.pop(update.effective_message.id)
+    if not _edit_message:
+        await update.callback_query.answer('⌛ Edit session expired', show_alert=True)
+        await update.callback_query.delete_message()
+        return
+    await forward_message(update, context, _edit_message.message_ids)
     await update.callback_query.answer('✅ Forwarded')
     await update.callback_query.delete_message()
-    del _edit_message
 
 
 async def query_template(update: Update, context: CustomContext) -> None:
     query = update.callback_query
+    _edit_message = context.chat_data.edit_message.get(query.message.message_id)
+    if not _edit_message:
+        await query.answer('⌛ Edit session expired', show_alert=True)
+        await query.delete_message()
+        return
     await query.answer()
     name = query.data.split("|")[1]
-    _edit_message = context.chat_data.edit_message[query.message.message_id]
     _edit_message.template = name
-    await _edit_message.forward[0].edit_caption(context.chat_data.template[name])
+    await context.bot.edit_message_caption(
+        chat_id=_edit_message.chat_id,
+        message_id=_edit_message.message_ids[0],
+        caption=context.chat_data.template[name]
+    )
 
 
 @send_action(ChatAction.TYPING)
@@ -171,8 +324,10 @@ async def cmd_start(update: Update, context: CustomContext) -> None:
         "Use /remove_forward_channel to remove the channel.\n"
         "Use /edit_before_forward to enable or disable edit before forward.\n"
         "Use /set_template to set a template for the forwarded message.\n"
+        "Use /send_original to also send the original images as documents.\n"
         "Use /bot_dict to see the bot's data.\n"
         "Use /clear_edit_message to clear the edit message cache.\n"
+        "Use /refresh to fetch a post again, ignoring the cache.\n"
         "You can also reply to a message with a tweet URL to fetch the tweet and forward it to the channel.\n"
         "You can also use inline query to search for tweets."
     )
@@ -232,6 +387,16 @@ async def cmd_edit_before_forward(update: Update, context: CustomContext) -> Non
     await update.effective_message.reply_text("Enable edit before forward.")
 
 
+@send_action(ChatAction.TYPING)
+async def cmd_send_original(update: Update, context: CustomContext) -> None:
+    if context.chat_data.send_original:
+        context.chat_data.send_original = False
+        await update.effective_message.reply_text("Disable sending original images.")
+        return
+    context.chat_data.send_original = True
+    await update.effective_message.reply_text("Enable sending original images as documents.")
+
+
 @send_action(ChatAction.TYPING)
 async def cmd_set_template(update: Update, context: CustomContext) -> None:
     reply = update.effective_message.reply_to_message
@@ -259,41 +424,96 @@ async def cmd_clear_edit_message(update: Update, context: CustomContext) -> None
     await update.effective_message.reply_text("Edit message cleared.")
 
 
+async def cmd_refresh(update: Update, context: CustomContext) -> None:
+    if not context.args:
+        await update.effective_message.reply_text("Please provide a url to refresh.")
+        return
+    await url_media(update, context, context.args[0], refresh=True)
+
+
+@send_action(ChatAction.TYPING)
+async def cmd_stats(update: Update, context: CustomContext) -> None:
+    stats = PostCache.stats()
+    await update.effective_message.reply_text(
+        "Post cache: {size} entries, {hits} hits, {misses} misses, {hit_ratio:.1%} hit ratio, "
+        "{coalesced} coalesced fetches, {shared_hits} from other workers\n".format(**stats) +
+        "Upload fallback: {urls} urls, {hosts} hosts\n".format(**UploadRoute.stats()) +
+        "Media cache: {size} bytes, {hits} hits, {misses} misses, {hit_ratio:.1%} hit ratio, "
+        "{bytes_saved} bytes saved\n".format(**MediaCache.stats()) +
+        "Updates: {running} running, {queued} queued in {chats} chats, {rejected} rejected".format(
+            **context.application.update_processor.stats()
+        )
+    )
+
+
+async def error_handler(update: object, context: CustomContext) -> None:
+    count_error(context.error)
+    logger.error("Exception while handling %s", update, exc_info=context.error)
+
+
 async def post_init(application: Application) -> None:
     # commands = [
     #     BotCommand('start', CMD_START),
     # ]
     # await application.bot.set_my_commands(commands)
     DESCRIPTION = "A bot to fetch tweets from Twitter."
-    await application.bot.set_my_description(DESCRIPTION)
-    await application.bot.set_my_short_description(DESCRIPTION)
+    if not common.WORKER_INDEX:
+        await application.bot.set_my_description(DESCRIPTION)
+        await application.bot.set_my_short_description(DESCRIPTION)
     NetClient.init_client()
+    NetClient.start_warm_up()
+    FileIdCache.init_db()
+    MediaCache.init_db()
+    if common.WORKERS > 1:
+        PostCache.init_db()
     if common.PIXIV_REFRESH_TOKEN:
         await ProcessPixiv.init_client(common.PIXIV_REFRESH_TOKEN)
+    if common.METRICS_PORT:
+        start_metrics_server(common.METRICS_PORT + common.WORKER_INDEX, common.METRICS_ADDR, {
+            'post': PostCache.stats,
+            'media': MediaCache.stats,
+        })
 
 
 async def post_stop(application: Application) -> None:
-    if common.ADMIN:
+    await ForwardBatch.flush()
+    if common.ADMIN and not common.WORKER_INDEX:
         await application.bot.send_message(common.ADMIN[0], "Shutting down...")
 
 
 async def post_shutdown(application: Application) -> None:
+    await Tracer.flush()  # otlp exports still need the client
     await NetClient.close_client()
+    if common.PIXIV_REFRESH_TOKEN:
+        await ProcessPixiv.close_client()
+    FileIdCache.close_db()
+    MediaCache.close_db()
+    PostCache.close_db()
+    ReplayStore.close_db()
+    Transcoder.close_pool()
 
 
-def main():
+def build_application() -> Application:
     defaults = Defaults(parse_mode=ParseMode.HTML, allow_sending_without_reply=True)
-    persistence = PicklePersistence(filepath='data/pers.pkl')
+    store_data = None
+    if common.WORKERS > 1:
+        # only chat rows belong to a single worker, user and bot rows would go to whichever worker wrote last.
+        # The bot keeps its state in chat_data
+        store_data = PersistenceInput(user_data=False, bot_data=False, callback_data=False)
+    persistence = SQLitePersistence(filepath='data/pers.sqlite', migrate_from='data/pers.pkl', store_data=store_data)
     application = (ApplicationBuilder()
                    .token(common.BOT_TOKEN)
+                   .base_url(common.BOT_API_URL)
+                   .base_file_url(common.BOT_API_FILE_URL)
                    .defaults(defaults)
                    .persistence(persistence)
                    .context_types(ContextTypes(context=CustomContext, chat_data=ChatData))
                    .post_init(post_init)
                    .post_stop(post_stop)
                    .post_shutdown(post_shutdown)
-                   .concurrent_updates(True)
-                   .http_version('2')
+                   .concurrent_updates(UpdateScheduler())
+                   .rate_limiter(SendLimiter(rate=common.SEND_GLOBAL_RATE / common.WORKERS, workers=common.WORKERS))
+                   .request(MetricsRequest(connection_pool_size=256, http_version=common.BOT_API_HTTP_VERSION))
                    .build()
                    )
 
@@ -310,15 +530,42 @@ def main():
         CommandHandler("remove_forward_channel", cmd_remove_forward_channel),
         CommandHandler("edit_before_forward", cmd_edit_before_forward),
         CommandHandler("set_template", cmd_set_template),
+        CommandHandler("send_original", cmd_send_original),
         MessageHandler(~filters.COMMAND & filters.ChatType.PRIVATE, handle_message),
         CallbackQueryHandler(query_forward_message, pattern="forward"),
         CallbackQueryHandler(query_template, pattern=r"^template\|"),
         CommandHandler("bot_dict", cmd_user_dict),
         CommandHandler("clear_edit_message", cmd_clear_edit_message),
+        CommandHandler("refresh", cmd_refresh),
+        CommandHandler("stats", cmd_stats, filters=user_filter),
     ]
 
+    for handler in handlers:
+        handler.callback = trace_handler(measure_handler(handler.callback))
     application.add_handlers(handlers)
+    application.add_error_handler(error_handler)
+    return application
+
+
+def run_worker(sock: socket.socket) -> None:
+    asyncio.run(serve_worker(build_application(), sock))
 
+
+def main():
+    if common.WORKERS > 1 or common.WEBHOOK_QUEUE:
+        asyncio.run(serve_front(
+            run_worker,
+            common.WORKERS,
+            listen=common.WEBHOOK_LISTEN,
+            port=common.WEBHOOK_PORT,
+            webhook_url=common.WEBHOOK_URL,
+            secret_token=common.WEBHOOK_SECRET_TOKEN,
+            key=common.WEBHOOK_KEY,
+            cert=common.WEBHOOK_CERT,
+            durable=common.WEBHOOK_QUEUE
+        ))
+        return
+    application = build_application()
     if common.WEBHOOK:
         application.run_webhook(
             listen=common.WEBHOOK_LISTEN,
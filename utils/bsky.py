@@ -1,10 +1,18 @@
 from __future__ import annotations
 
+import os
+import tempfile
 from functools import cached_property
+from pathlib import Path
 from typing import TYPE_CHECKING
 
+from utils.cache import PostCache
+from utils.hls import download_hls
+from utils.media import MediaCache
 from utils.net import NetClient
 from utils.regex import bsky_url
+from utils.transcode import Transcoder, ts_to_mp4
+from utils.upload import UPLOAD_LIMIT
 
 if TYPE_CHECKING:
     from utils.types import BskyEmbedImages, BskyInfo, BskyEmbedVideo, BskyEmbedExternal
@@ -86,10 +94,11 @@ class Bsky:
 
 
 class ProcessBsky:
-    __slots__ = ('_url', '_id', '_bsky')
+    __slots__ = ('_url', '_refresh', '_id', '_bsky')
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False):
         self._url: str = url
+        self._refresh: bool = refresh
 
     async def __aenter__(self):
         bsky = await self._fetch_bsky()
@@ -113,9 +122,14 @@ class ProcessBsky:
         if not match:
             raise ValueError(f"Invalid Bsky URL: {self._url}")
         auther_id, self._id = match.groups()
-        return await NetClient.fetch_json(
-            bsky_api_url,
-            params={'uri': f'at://{auther_id}/app.bsky.feed.post/{self._id}', 'depth': 0}
+        return await PostCache.fetch(
+            'bsky',
+            f'{auther_id.lower()}/{self._id}',
+            lambda: NetClient.fetch_json(
+                bsky_api_url,
+                params={'uri': f'at://{auther_id}/app.bsky.feed.post/{self._id}', 'depth': 0}
+            ),
+            refresh=self._refresh
         )
 
     @property
@@ -161,3 +175,24 @@ class ProcessBsky:
             for label in self._bsky['labels']
             for tag in SENSITIVE_TAG
         )
+
+
+class ProcessBskyVideo:
+    __slots__ = ('_playlist',)
+
+    def __init__(self, playlist: str):
+        self._playlist: str = playlist
+
+    async def __aenter__(self) -> Path:
+        return await MediaCache.render(f'bsky-video:{self._playlist}', '.mp4', self._render)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def _render(self, output: str) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            ts_path = os.path.join(tmp, 'video.ts')
+            size = await download_hls(self._playlist, ts_path)
+            if size > UPLOAD_LIMIT:
+                raise ValueError(f"Bsky video too large to upload: {size} bytes")
+            await Transcoder.run(ts_to_mp4, ts_path, output)
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, Hashable, TypeVar
+
+from common import POST_CACHE_DB, POST_CACHE_SIZE, POST_CACHE_TTL
+from .db import SQLiteWriter, connect_sqlite
+from .logger import get_logger
+from .metrics import UPSTREAM_LATENCY
+
+logger = get_logger(__name__)
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    __slots__ = ('_maxsize', '_ttl', '_data', 'hits', 'misses')
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize: int = maxsize
+        self._ttl: float = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __str__(self):
+        return f"TTLCache(size={len(self)}/{self._maxsize}, ttl={self._ttl}, hits={self.hits}, misses={self.misses})"
+
+    __repr__ = __str__
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] > time.time()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expire, value = item
+        if expire <= time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self._data[key] = (time.time() + self._ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K, default: V | None = None) -> V | None:
+        item = self._data.pop(key, None)
+        if item is None or item[0] <= time.time():
+            return default
+        return item[1]
+
+    def expire(self) -> None:
+        now = time.time()
+        for key in [key for key, (expire, _) in self._data.items() if expire <= now]:
+            del self._data[key]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class SingleFlight(Generic[K, V]):
+    __slots__ = ('_calls', 'coalesced')
+
+    def __init__(self):
+        self._calls: dict[K, asyncio.Future[V]] = {}
+        self.coalesced: int = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: K, fetch: Callable[[], Awaitable[V]]) -> V:
+        if (future := self._calls.get(key)) is None:
+            future = asyncio.ensure_future(fetch())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.coalesced += 1
+        # shield so a cancelled waiter doesn't cancel the fetch shared with the others
+        return await asyncio.shield(future)
+
+    def _done(self, key: K, future: asyncio.Future[V]) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()  # mark as retrieved when every waiter is gone
+
+
+# Posts are kept in memory, and also pickled into SQLite once init_db is called so worker processes share
+# what the others fetched. Posts that can't be pickled stay in memory only.
+class PostCache:
+    _cache: TTLCache[tuple[str, str], Any] = TTLCache(POST_CACHE_SIZE, POST_CACHE_TTL)
+    _flights: SingleFlight[tuple[str, str], Any] = SingleFlight()
+    _db: sqlite3.Connection | None = None
+    _writer: SQLiteWriter | None = None
+    shared_hits: int = 0
+
+    @classmethod
+    def init_db(cls, path: str = POST_CACHE_DB) -> None:
+        cls._db = connect_sqlite(path)
+        cls._db.execute(
+            "CREATE TABLE IF NOT EXISTS post (key TEXT PRIMARY KEY, value BLOB NOT NULL, expire REAL NOT NULL)"
+        )
+        cls._writer = SQLiteWriter(path)
+        cls._writer.execute("DELETE FROM post WHERE expire <= ?", (time.time(),))
+
+    @classmethod
+    def close_db(cls) -> None:
+        if cls._db is not None:
+            cls._writer.close()
+            cls._db.close()
+            cls._db = cls._writer = None
+
+    @classmethod
+    def _load(cls, key: tuple[str, str]) -> Any:
+        if cls._db is None:
+            return None
+        row = cls._db.execute("SELECT value, expire FROM post WHERE key = ?", ('/'.join(key),)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        value = pickle.loads(row[0])
+        cls._cache.set(key, value)
+        cls.shared_hits += 1
+        return value
+
+    @classmethod
+    def _store(cls, key: tuple[str, str], value: Any) -> None:
+        if cls._db is None:
+            return
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.debug("Not sharing %s, it can't be pickled: %r", key, e)
+            return
+        cls._writer.execute(
+            "INSERT OR REPLACE INTO post (key, value, expire) VALUES (?, ?, ?)",
+            ('/'.join(key), data, time.time() + POST_CACHE_TTL)
+        )
+
+    @classmethod
+    async def fetch(
+            cls,
+            platform: str,
+            post_id: str,
+            fetch: Callable[[], Awaitable[V]],
+            refresh: bool = False
+    ) -> V:
+        key = (platform, post_id)
+        if not refresh and ((value := cls._cache.get(key)) is not None or (value := cls._load(key)) is not None):
+            return value
+
+        async def fetch_and_store() -> V:
+            with UPSTREAM_LATENCY.labels(platform).time():
+                result = await fetch()
+            cls._cache.set(key, result)
+            cls._store(key, result)
+            return result
+
+        return await cls._flights.do(key, fetch_and_store)
+
+    @classmethod
+    def invalidate(cls, platform: str, post_id: str) -> None:
+        cls._cache.pop((platform, post_id))
+        if cls._db is not None:
+            cls._writer.execute("DELETE FROM post WHERE key = ?", (f"{platform}/{post_id}",))
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        return {
+            'size': len(cls._cache),
+            'hits': cls._cache.hits,
+            'misses': cls._cache.misses,
+            'hit_ratio': cls._cache.hit_ratio,
+            'inflight': len(cls._flights),
+            'coalesced': cls._flights.coalesced,
+            'shared_hits': cls.shared_hits,
+        }
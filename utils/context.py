@@ -1,36 +1,57 @@
 import dataclasses
+import time
 from typing import Optional
 
-from telegram import Message
 from telegram.ext import Application, CallbackContext, ExtBot
 
+from common import EDIT_MESSAGE_SIZE, EDIT_MESSAGE_TTL
+from .cache import TTLCache
+
 
 @dataclasses.dataclass(repr=False)
 class EditMessage:
+    chat_id: int
+    message_ids: tuple[int, ...]
     url: str
-    forward: tuple[Message, ...]
     template: str = ""
+    created_at: float = dataclasses.field(default_factory=time.time)
 
     def __str__(self):
-        forward = ", ".join(f"Message({f.id})" for f in self.forward)
-        return f"EditMessage(url={self.url}, forward={forward}, template={self.template})"
+        return f"EditMessage(chat_id={self.chat_id}, message_ids={self.message_ids}, url={self.url}, " \
+               f"template={self.template})"
 
     __repr__ = __str__
 
 
+def edit_message_store() -> TTLCache[int, EditMessage]:
+    return TTLCache(EDIT_MESSAGE_SIZE, EDIT_MESSAGE_TTL)
+
+
 class ChatData:
     def __init__(self):
         self.forward_channel_id: Optional[int] = None
         self.edit_before_forward: bool = False
-        self.edit_message: dict[int, EditMessage] = {}
+        self.edit_message: TTLCache[int, EditMessage] = edit_message_store()
         self.template: dict[str, str] = {}
+        self.send_original: bool = False
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('send_original', False)
+        if not isinstance(self.edit_message, TTLCache):  # sessions stored as a plain dict of Message tuples
+            self.edit_message = edit_message_store()
 
     def __str__(self):
         return f"ChatData(forward_channel_id={self.forward_channel_id}, edit_before_forward={self.edit_before_forward}, " \
-               f"edit_message={self.edit_message}, template={self.template})"
+               f"edit_message={self.edit_message}, template={self.template}, " \
+               f"send_original={self.send_original})"
 
     __repr__ = __str__
 
+    def add_edit_message(self, message_id: int, edit_message: EditMessage) -> None:
+        self.edit_message.expire()
+        self.edit_message.set(message_id, edit_message)
+
 
 class CustomContext(CallbackContext[ExtBot, dict, ChatData, dict]):
     def __init__(
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Sequence, TypeVar
+
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar('T')
+
+BUSY_TIMEOUT = 5000  # ms to wait for another connection (or worker process) holding the write lock
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+
+
+def connect_sqlite(path: str | os.PathLike) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+    return db
+
+
+def _log_failure(future: Future) -> None:
+    if not future.cancelled() and (error := future.exception()):
+        logger.warning("SQLite write failed: %r", error)
+
+
+# Writes to a store the worker processes share can wait up to BUSY_TIMEOUT for another process's write lock,
+# so they run in order on one background thread, over a connection of their own, instead of on the event
+# loop. Reads stay on the store's connection: in WAL mode readers don't wait for writers.
+class SQLiteWriter:
+    __slots__ = ('_path', '_db')
+
+    def __init__(self, path: str | os.PathLike):
+        self._path: str | os.PathLike = path
+        self._db: sqlite3.Connection | None = None
+
+    def submit(self, func: Callable[[sqlite3.Connection], T]) -> Future[T]:
+        future = _executor.submit(self._run, func)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def execute(self, sql: str, parameters: Sequence[Any] = ()) -> Future[int]:
+        return self.submit(lambda db: db.execute(sql, parameters).rowcount)
+
+    def _run(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        if self._db is None:
+            self._db = connect_sqlite(self._path)
+        return func(self._db)
+
+    def close(self) -> None:
+        # queued after every write submitted so far, so those are done once this returns
+        _executor.submit(self._close).result()
+
+    def _close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+from typing import Literal, Sequence, TYPE_CHECKING
+
+from telegram import InputFile
+
+from common import FILE_ID_DB
+from .cache import TTLCache
+from .db import SQLiteWriter, connect_sqlite
+from .logger import get_logger
+
+if TYPE_CHECKING:
+    from telegram import Message
+
+    from .types import TypeMessageMediaResult
+
+logger = get_logger(__name__)
+
+SERVED_SIZE = 4096
+SERVED_TTL = 3600
+
+FileType = Literal["photo", "video", "animation"]
+
+
+def message_file_id(message: Message) -> tuple[str, FileType] | None:
+    if message.photo:
+        return message.photo[-1].file_id, "photo"
+    if message.animation:
+        return message.animation.file_id, "animation"
+    if message.video:
+        return message.video.file_id, "video"
+    return None
+
+
+class FileIdCache:
+    _db: sqlite3.Connection | None = None
+    _writer: SQLiteWriter | None = None
+    _local_sources: dict[str, str] = {}  # name of a locally rendered file -> source it was rendered from
+    _served: TTLCache[str, str] = TTLCache(SERVED_SIZE, SERVED_TTL)  # file_id handed out -> url it was cached for
+
+    @classmethod
+    def init_db(cls, path: str = FILE_ID_DB) -> None:
+        cls._db = connect_sqlite(path)
+        cls._db.execute(
+            "CREATE TABLE IF NOT EXISTS file_id ("
+            "url TEXT PRIMARY KEY, file_id TEXT NOT NULL, type TEXT NOT NULL)"
+        )
+        cls._writer = SQLiteWriter(path)
+
+    @classmethod
+    def close_db(cls) -> None:
+        if cls._db is not None:
+            cls._writer.close()
+            cls._db.close()
+            cls._db = cls._writer = None
+
+    @classmethod
+    def get(cls, url: str, file_type: FileType) -> str | None:
+        if cls._db is None:
+            return None
+        row = cls._db.execute("SELECT file_id, type FROM file_id WHERE url = ?", (url,)).fetchone()
+        if row is None or row[1] != file_type:
+            return None
+        cls._served.set(row[0], url)
+        return row[0]
+
+    @classmethod
+    def set(cls, url: str, file_id: str, file_type: FileType) -> None:
+        if cls._db is None:
+            return
+        cls._writer.execute(
+            "INSERT OR REPLACE INTO file_id (url, file_id, type) VALUES (?, ?, ?)",
+            (url, file_id, file_type)
+        )
+
+    @classmethod
+    def delete(cls, url: str) -> None:
+        if cls._db is None:
+            return
+        cls._writer.execute("DELETE FROM file_id WHERE url = ?", (url,))
+
+    @classmethod
+    def forget(cls, media: Sequence[TypeMessageMediaResult]) -> list[TypeMessageMediaResult] | None:
+        # put back the urls of file_ids Telegram rejected (stale, or from another bot) and drop them from the
+        # cache; None when the media had no cached file_ids
+        restored, changed = [], False
+        for item in media:
+            source = item[0] if isinstance(item, tuple) else item.media
+            if not isinstance(source, str) or (url := cls._served.pop(source)) is None:
+                restored.append(item)
+                continue
+            logger.info("Dropping cached file_id for %s", url)
+            cls.delete(url)
+            changed = True
+            if isinstance(item, tuple):
+                restored.append((url, *item[1:]))
+            else:
+                with item._unfrozen():
+                    item.media = url
+                restored.append(item)
+        return restored if changed else None
+
+    @classmethod
+    def local_file(cls, path: Path, source: str) -> Path:
+        cls._local_sources[path.name] = source
+        return path
+
+    @classmethod
+    def _source(cls, media: object) -> str | None:
+        if isinstance(media, str):
+            return media if media.startswith("http") else cls._served.pop(media)
+        if isinstance(media, InputFile):
+            return cls._local_sources.pop(media.filename, None)
+        if isinstance(media, Path):
+            return cls._local_sources.pop(media.name, None)
+        return None
+
+    @classmethod
+    def record(cls, media: Sequence[TypeMessageMediaResult], messages: Sequence[Message]) -> None:
+        for item, message in zip(media, messages):
+            url = cls._source(item[0] if isinstance(item, tuple) else item.media)
+            if url is None:
+                continue
+            if result := message_file_id(message):
+                logger.debug("Cache file_id for %s", url)
+                cls.set(url, *result)
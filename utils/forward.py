@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Sequence, TYPE_CHECKING
+
+from common import FORWARD_BATCH_SIZE, FORWARD_BATCH_WINDOW
+from .logger import get_logger
+from .metrics import FORWARD_BATCH
+
+if TYPE_CHECKING:
+    from telegram import Bot, MessageId
+
+logger = get_logger(__name__)
+
+
+class ForwardError(Exception):
+    pass
+
+
+class _Forward:
+    __slots__ = ('from_chat_id', 'message_ids', 'future')
+
+    def __init__(self, from_chat_id: int, message_ids: Sequence[int], future: asyncio.Future):
+        self.from_chat_id: int = from_chat_id
+        self.message_ids: tuple[int, ...] = tuple(message_ids)
+        self.future: asyncio.Future = future
+
+
+class _Channel:
+    __slots__ = ('pending', 'size', 'full', 'task')
+
+    def __init__(self):
+        self.pending: list[_Forward] = []
+        self.size: int = 0
+        self.full: asyncio.Event = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+
+def split_runs(forwards: Sequence[_Forward], limit: int) -> list[list[_Forward]]:
+    # one copy_messages call per run: same source chat, at most `limit` ids. The API wants the ids increasing,
+    # so a forward with an id not above the run's last one starts a new run rather than be sent out of order
+    runs: list[list[_Forward]] = []
+    size = last = 0
+    for forward in forwards:
+        run = runs[-1] if runs else None
+        if (run is None or run[0].from_chat_id != forward.from_chat_id
+                or size + len(forward.message_ids) > limit or min(forward.message_ids, default=last + 1) <= last):
+            runs.append(run := [])
+            size = last = 0
+        run.append(forward)
+        size += len(forward.message_ids)
+        last = max(forward.message_ids, default=last)
+    return runs
+
+
+# Copies to the same channel are held for `window` seconds (less once `size` ids are waiting) and sent as one
+# copy_messages call per run of messages from the same chat, in the order they were queued. Each caller gets
+# the copies of its own messages back, or the error of the call they went out in.
+class ForwardBatch:
+    _channels: dict[int | str, _Channel] = {}
+
+    @classmethod
+    async def copy(
+            cls,
+            bot: Bot,
+            from_chat_id: int,
+            to_chat_id: int | str,
+            message_ids: Sequence[int]
+    ) -> tuple[MessageId, ...]:
+        forward = _Forward(from_chat_id, message_ids, asyncio.get_running_loop().create_future())
+        if (channel := cls._channels.get(to_chat_id)) is None:
+            channel = cls._channels[to_chat_id] = _Channel()
+        channel.pending.append(forward)
+        channel.size += len(forward.message_ids)
+        if channel.size >= FORWARD_BATCH_SIZE:
+            channel.full.set()
+        if channel.task is None:
+            channel.task = asyncio.create_task(cls._run(bot, to_chat_id, channel), name=f"ForwardBatch.{to_chat_id}")
+        return await forward.future
+
+    @classmethod
+    async def _run(cls, bot: Bot, to_chat_id: int | str, channel: _Channel) -> None:
+        try:
+            while channel.pending:
+                try:
+                    async with asyncio.timeout(FORWARD_BATCH_WINDOW):
+                        await channel.full.wait()
+                except TimeoutError:
+                    pass
+                forwards, channel.pending, channel.size = channel.pending, [], 0
+                channel.full.clear()
+                forwards = [forward for forward in forwards if not forward.future.done()]  # callers gone
+                for run in split_runs(forwards, FORWARD_BATCH_SIZE):
+                    await cls._send(bot, to_chat_id, run)
+        finally:
+            del cls._channels[to_chat_id]
+            for forward in channel.pending:  # only left over if cancelled
+                forward.future.cancel()
+
+    @classmethod
+    async def _send(cls, bot: Bot, to_chat_id: int | str, run: list[_Forward]) -> None:
+        ids = [i for forward in run for i in sorted(set(forward.message_ids))]
+        FORWARD_BATCH.observe(len(ids))
+        try:
+            copies = await bot.copy_messages(to_chat_id, run[0].from_chat_id, ids)
+        except asyncio.CancelledError:
+            for forward in run:
+                forward.future.cancel()
+            raise
+        except Exception as e:
+            logger.warning("Failed to copy %d messages from %s to %s: %r", len(ids), run[0].from_chat_id,
+                           to_chat_id, e)
+            for forward in run:
+                if not forward.future.done():
+                    forward.future.set_exception(e)
+            return
+        if len(copies) != len(ids):
+            # skipped messages aren't reported, so there is no telling whose they were
+            logger.warning("Only %d of %d messages from %s were copied to %s", len(copies), len(ids),
+                           run[0].from_chat_id, to_chat_id)
+            error = ForwardError(f"Only {len(copies)} of {len(ids)} messages were copied to the channel.")
+            for forward in run:
+                if not forward.future.done():
+                    forward.future.set_exception(error)
+            return
+        copied = dict(zip(ids, copies))
+        for forward in run:
+            if not forward.future.done():
+                forward.future.set_result(tuple(copied[i] for i in forward.message_ids))
+
+    @classmethod
+    async def flush(cls) -> None:
+        for channel in list(cls._channels.values()):
+            channel.full.set()
+        await asyncio.gather(*(channel.task for channel in list(cls._channels.values())), return_exceptions=True)
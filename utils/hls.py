@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from collections import deque
+from urllib.parse import urljoin
+
+from common import HLS_WINDOW
+from .logger import get_logger
+from .net import NetClient
+
+logger = get_logger(__name__)
+
+
+def parse_attributes(line: str) -> dict[str, str]:
+    attributes = {}
+    key, value, quoted = '', '', False
+    reading_key = True
+    for char in line.split(':', 1)[1] if ':' in line else '':
+        if reading_key:
+            if char == '=':
+                reading_key = False
+            else:
+                key += char
+        elif char == '"':
+            quoted = not quoted
+        elif char == ',' and not quoted:
+            attributes[key.strip()] = value
+            key, value, reading_key = '', '', True
+        else:
+            value += char
+    if key:
+        attributes[key.strip()] = value
+    return attributes
+
+
+def best_variant(playlist: str, base_url: str) -> str | None:
+    best, best_bandwidth = None, -1
+    stream_info = None
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF'):
+            stream_info = parse_attributes(line)
+        elif line and not line.startswith('#') and stream_info is not None:
+            bandwidth = int(stream_info.get('BANDWIDTH', 0))
+            if bandwidth > best_bandwidth:
+                best, best_bandwidth = urljoin(base_url, line), bandwidth
+            stream_info = None
+    return best
+
+
+def media_segments(playlist: str, base_url: str) -> list[str]:
+    segments = []
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MAP'):
+            segments.append(urljoin(base_url, parse_attributes(line)['URI']))
+        elif line.startswith('#EXT-X-KEY') and parse_attributes(line).get('METHOD', 'NONE') != 'NONE':
+            raise ValueError(f"Encrypted HLS playlist is not supported: {base_url}")
+        elif line and not line.startswith('#'):
+            segments.append(urljoin(base_url, line))
+    return segments
+
+
+async def hls_segments(url: str) -> list[str]:
+    playlist = await NetClient.fetch_text(url)
+    if '#EXT-X-STREAM-INF' in playlist:
+        if (variant := best_variant(playlist, url)) is None:
+            raise ValueError(f"No variant stream in HLS playlist: {url}")
+        url = variant
+        playlist = await NetClient.fetch_text(url)
+    return media_segments(playlist, url)
+
+
+async def download_hls(url: str, path: str | os.PathLike, window: int = HLS_WINDOW) -> int:
+    segments = await hls_segments(url)
+    logger.debug("Download %d HLS segments from %s", len(segments), url)
+    size = 0
+    # at most `window` segments are in flight or buffered, they are written to disk in playlist order
+    tasks: deque[asyncio.Task[bytes]] = deque()
+    pending = iter(segments)
+    try:
+        with open(path, 'wb') as file:
+            for segment in pending:
+                tasks.append(asyncio.create_task(NetClient.fetch_bytes(segment)))
+                if len(tasks) >= window:
+                    break
+            while tasks:
+                data = await tasks.popleft()
+                if (segment := next(pending, None)) is not None:
+                    tasks.append(asyncio.create_task(NetClient.fetch_bytes(segment)))
+                file.write(data)
+                size += len(data)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return size
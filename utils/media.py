@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from common import MEDIA_CACHE_DB, MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE
+from .cache import SingleFlight
+from .db import SQLiteWriter, connect_sqlite
+from .logger import get_logger
+from .net import NetClient
+
+logger = get_logger(__name__)
+
+
+def file_digest(path: str | os.PathLike) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+# Downloads are stored once per content hash under MEDIA_CACHE_DIR, with an SQLite index from source url to
+# blob. Blobs are written to a temp file and moved into place with os.replace, so concurrent writers (other
+# tasks or worker processes) never see a partial file. Files the bot renders itself (transcodes, shrunk photos)
+# are stored the same way under a key of their own. The least recently used entries are evicted once the blobs
+# exceed MEDIA_CACHE_SIZE bytes.
+class MediaCache:
+    _db: sqlite3.Connection | None = None
+    _writer: SQLiteWriter | None = None
+    _root: Path = Path(MEDIA_CACHE_DIR)
+    _max_size: int = MEDIA_CACHE_SIZE
+    _flights: SingleFlight[str, Path] = SingleFlight()
+    _total: int = 0
+    hits: int = 0
+    misses: int = 0
+    bytes_saved: int = 0
+
+    @classmethod
+    def init_db(
+            cls,
+            path: str = MEDIA_CACHE_DB,
+            root: str = MEDIA_CACHE_DIR,
+            max_size: int = MEDIA_CACHE_SIZE
+    ) -> None:
+        cls._root = Path(root)
+        cls._max_size = max_size
+        (cls._root / 'tmp').mkdir(parents=True, exist_ok=True)
+        cls._db = connect_sqlite(path)
+        cls._db.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            "url TEXT PRIMARY KEY, hash TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        cls._db.execute("CREATE INDEX IF NOT EXISTS media_accessed ON media (accessed)")
+        cls._writer = SQLiteWriter(path)
+        cls._total = cls._blob_size(cls._db)
+
+    @classmethod
+    def close_db(cls) -> None:
+        if cls._db is not None:
+            cls._writer.close()
+            cls._db.close()
+            cls._db = cls._writer = None
+
+    @staticmethod
+    def _blob_size(db: sqlite3.Connection) -> int:
+        return db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT name, size FROM media)"
+        ).fetchone()[0]
+
+    @classmethod
+    def get(cls, url: str) -> Path | None:
+        if cls._db is None:
+            return None
+        row = cls._db.execute("SELECT name, size FROM media WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        path = cls._root / row[0]
+        if not path.exists():
+            cls._writer.execute("DELETE FROM media WHERE url = ?", (url,))
+            return None
+        cls._writer.execute("UPDATE media SET accessed = ? WHERE url = ?", (time.time(), url))
+        cls.hits += 1
+        cls.bytes_saved += row[1]
+        return path
+
+    @classmethod
+    async def fetch(cls, url: str, suffix: str = '', headers: dict = None, max_size: int | None = None) -> Path:
+        if cls._db is None:
+            cls.init_db()
+        if (path := cls.get(url)) is not None:
+            return path
+        return await cls._flights.do(url, lambda: cls._download(url, suffix, headers, max_size))
+
+    @classmethod
+    async def render(cls, key: str, suffix: str, write: Callable[[str], Awaitable[object]]) -> Path:
+        # write(path) creates the file at path, it only runs when key isn't cached
+        if cls._db is None:
+            cls.init_db()
+        if (path := cls.get(key)) is not None:
+            return path
+        return await cls._flights.do(key, lambda: cls._store(key, suffix, write))
+
+    @classmethod
+    async def _download(cls, url: str, suffix: str, headers: dict | None, max_size: int | None) -> Path:
+        return await cls._store(
+            url, suffix, lambda tmp: NetClient.download(url, tmp, headers=headers, max_size=max_size)
+        )
+
+    @classmethod
+    async def _store(cls, key: str, suffix: str, write: Callable[[str], Awaitable[object]]) -> Path:
+        cls.misses += 1
+        fd, tmp = tempfile.mkstemp(suffix=suffix, dir=cls._root / 'tmp')
+        os.close(fd)
+        try:
+            await write(tmp)
+            size = os.path.getsize(tmp)
+            digest = await asyncio.to_thread(file_digest, tmp)
+            name = f"{digest[:2]}/{digest}{suffix}"
+            path = cls._root / name
+            path.parent.mkdir(exist_ok=True)
+            exists = path.exists()
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        await asyncio.wrap_future(cls._writer.submit(lambda db: cls._index(db, key, digest, name, size, exists)))
+        return path
+
+    @classmethod
+    def _index(cls, db: sqlite3.Connection, key: str, digest: str, name: str, size: int, exists: bool) -> None:
+        db.execute(
+            "INSERT OR REPLACE INTO media (url, hash, name, size, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, digest, name, size, time.time())
+        )
+        if not exists:
+            cls._total += size
+            cls._evict(db)
+
+    @classmethod
+    def _evict(cls, db: sqlite3.Connection) -> None:
+        if cls._total <= cls._max_size:
+            return
+        cls._total = cls._blob_size(db)  # other worker processes may have added blobs too
+        while cls._total > cls._max_size:
+            row = db.execute("SELECT url, name, size FROM media ORDER BY accessed LIMIT 1").fetchone()
+            if row is None:
+                break
+            url, name, size = row
+            db.execute("DELETE FROM media WHERE url = ?", (url,))
+            if db.execute("SELECT 1 FROM media WHERE name = ?", (name,)).fetchone():
+                continue  # the same content is still cached under another url
+            # senders that already opened the blob keep reading it after the unlink
+            (cls._root / name).unlink(missing_ok=True)
+            cls._total -= size
+            logger.debug("Evicted %s from media cache, %d bytes", url, size)
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        total = cls.hits + cls.misses
+        return {
+            'size': cls._total,
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'hit_ratio': cls.hits / total if total else 0.0,
+            'bytes_saved': cls.bytes_saved,
+        }
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import time
+from functools import wraps
+from typing import Any, Awaitable, Callable, Iterable, TYPE_CHECKING
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+from telegram.request import HTTPXRequest
+
+from .logger import get_logger
+
+if TYPE_CHECKING:
+    from telegram.request import RequestData
+
+logger = get_logger(__name__)
+
+UPSTREAM_LATENCY = Histogram(
+    'bot_upstream_fetch_seconds',
+    'Latency of fetching a post from its provider, cache misses only',
+    ['provider'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+BOT_API_LATENCY = Histogram(
+    'bot_telegram_api_seconds',
+    'Latency of Telegram Bot API calls',
+    ['method'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+HANDLER_DURATION = Histogram(
+    'bot_handler_seconds',
+    'Time spent in update handlers',
+    ['handler'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+UPDATES_IN_FLIGHT = Gauge('bot_updates_in_flight', 'Updates currently being processed')
+UPDATE_QUEUE_DEPTH = Gauge('bot_update_queue_depth', 'Updates waiting for a processing slot', ['lane'])
+UPDATE_WAIT = Histogram(
+    'bot_update_wait_seconds',
+    'Time updates wait for a processing slot',
+    ['lane'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+UPDATES_REJECTED = Counter('bot_updates_rejected_total', 'Updates dropped because their queue was full')
+SEND_QUEUE_DEPTH = Gauge('bot_send_queue_depth', 'Bot API calls waiting for flood control')
+SEND_WAIT = Histogram(
+    'bot_send_wait_seconds',
+    'Time Bot API calls wait for flood control',
+    ['priority'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+RETRY_AFTER = Counter('bot_retry_after_total', 'RetryAfter errors returned by the Bot API')
+FORWARD_BATCH = Histogram(
+    'bot_forward_batch_messages',
+    'Messages copied to a channel per copy_messages call',
+    buckets=(1, 2, 4, 10, 20, 50, 100)
+)
+ERRORS = Counter('bot_errors_total', 'Errors raised while handling updates', ['type'])
+
+
+def count_error(error: BaseException) -> None:
+    ERRORS.labels(type(error).__name__).inc()
+
+
+def measure_handler(callback: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    histogram = HANDLER_DURATION.labels(callback.__name__)
+
+    @wraps(callback)
+    async def measured(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return measured
+
+
+class MetricsRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, **kwargs)
+        finally:
+            BOT_API_LATENCY.labels(url.rsplit('/', 1)[-1]).observe(time.perf_counter() - start)
+
+
+class CacheCollector(Collector):
+    def __init__(self, caches: dict[str, Callable[[], dict[str, int | float]]]):
+        self._caches = caches
+
+    def collect(self) -> Iterable[CounterMetricFamily | GaugeMetricFamily]:
+        hits = CounterMetricFamily('bot_cache_hits', 'Cache hits', labels=['cache'])
+        misses = CounterMetricFamily('bot_cache_misses', 'Cache misses', labels=['cache'])
+        ratio = GaugeMetricFamily('bot_cache_hit_ratio', 'Cache hit ratio since start', labels=['cache'])
+        size = GaugeMetricFamily('bot_cache_size', 'Entries (or bytes for the media cache)', labels=['cache'])
+        for name, stats in self._caches.items():
+            values = stats()
+            hits.add_metric([name], values['hits'])
+            misses.add_metric([name], values['misses'])
+            ratio.add_metric([name], values['hit_ratio'])
+            size.add_metric([name], values['size'])
+        yield from (hits, misses, ratio, size)
+
+
+def start_metrics_server(port: int, addr: str, caches: dict[str, Callable[[], dict[str, int | float]]]) -> None:
+    REGISTRY.register(CacheCollector(caches))
+    try:
+        start_http_server(port, addr)
+    except OSError as e:
+        # metrics are optional, a taken port must not keep the bot from starting
+        logger.error("Failed to serve metrics on %s:%d: %r", addr, port, e)
+        return
+    logger.warning("Serving metrics on http://%s:%d/metrics", addr, port)
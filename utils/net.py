@@ -1,24 +1,185 @@
 from __future__ import annotations
 
-from httpx import AsyncClient
+import asyncio
+import random
+import time
+from collections import defaultdict
+from os import PathLike
+
+from httpx import (AsyncBaseTransport, AsyncClient, AsyncHTTPTransport, HTTPError, Limits, Request, Response, Timeout,
+                   TransportError, URL)
+
+from common import (NET_BREAKER_COOLDOWN, NET_BREAKER_THRESHOLD, NET_CONNECT_TIMEOUT, NET_HOST_OVERRIDES,
+                    NET_KEEPALIVE_EXPIRY, NET_MAX_CONNECTIONS, NET_MAX_HOST_CONNECTIONS, NET_MAX_KEEPALIVE_CONNECTIONS,
+                    NET_POOL_TIMEOUT, NET_READ_TIMEOUT, NET_REPLAY_MODE, NET_RETRY_ATTEMPTS, NET_RETRY_BACKOFF,
+                    NET_RETRY_MAX_BACKOFF, NET_WARM_UP_HOSTS, NET_WRITE_TIMEOUT)
+from .logger import get_logger
+from .replay import ReplayTransport
+
+logger = get_logger(__name__)
+
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+
+class UpstreamError(Exception):
+    def __init__(self, url: str, status_code: int | None = None, retry_after: float | None = None):
+        super().__init__(f"Failed to fetch {url}, status code {status_code}")
+        self.url: str = url
+        self.status_code: int | None = status_code
+        self.retry_after: float | None = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status_code in RETRY_STATUS
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, url: str):
+        super().__init__(f"Circuit open for {URL(url).host}, skip fetching {url}")
+        self.url: str = url
+
+
+class CircuitBreaker:
+    __slots__ = ('_threshold', '_cooldown', '_failures', '_opened_at')
+
+    def __init__(self, threshold: int = NET_BREAKER_THRESHOLD, cooldown: float = NET_BREAKER_COOLDOWN):
+        self._threshold: int = threshold
+        self._cooldown: float = cooldown
+        self._failures: int = 0
+        self._opened_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if time.monotonic() - self._opened_at < self._cooldown:
+            return False
+        self._opened_at = time.monotonic()  # half-open: let one request through per cooldown
+        return True
+
+    def success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self._threshold:
+            self._opened_at = time.monotonic()
+
+
+class HostOverrideTransport(AsyncBaseTransport):
+    # sends requests for the mapped hosts elsewhere, keeping the original Host header
+    def __init__(self, transport: AsyncBaseTransport, overrides: dict[str, str]):
+        self._transport: AsyncBaseTransport = transport
+        self._overrides: dict[str, URL] = {host: URL(target) for host, target in overrides.items()}
+
+    async def handle_async_request(self, request: Request) -> Response:
+        if target := self._overrides.get(request.url.host):
+            request.url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def wrap_transport(transport: AsyncBaseTransport, response_class: type[Response] = Response) -> AsyncBaseTransport:
+    if NET_HOST_OVERRIDES:
+        transport = HostOverrideTransport(transport, NET_HOST_OVERRIDES)
+    if NET_REPLAY_MODE:
+        # outermost, so fixtures are keyed by the original url
+        transport = ReplayTransport(transport, response_class=response_class)
+    return transport
 
 
 def create_client() -> AsyncClient:
-    return AsyncClient(http2=True)
+    transport = AsyncHTTPTransport(
+        http2=True,
+        limits=Limits(
+            max_connections=NET_MAX_CONNECTIONS,
+            max_keepalive_connections=NET_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=NET_KEEPALIVE_EXPIRY
+        )
+    )
+    return AsyncClient(
+        transport=wrap_transport(transport),
+        timeout=Timeout(
+            connect=NET_CONNECT_TIMEOUT,
+            read=NET_READ_TIMEOUT,
+            write=NET_WRITE_TIMEOUT,
+            pool=NET_POOL_TIMEOUT
+        )
+    )
 
 
 async def close_client(_client: AsyncClient) -> None:
     return await _client.aclose()
 
 
-async def fetch_json(_client: AsyncClient, url: str, params: dict = None) -> dict:
-    response = await _client.get(url, params=params)
-    assert response.is_success, f"Failed to fetch {url}, status code {response.status_code}"
-    return response.json()
+async def fetch(_client: AsyncClient, url: str, params: dict = None, headers: dict = None) -> Response:
+    response = await _client.get(url, params=params, headers=headers)
+    if not response.is_success:
+        retry_after = response.headers.get('retry-after')
+        raise UpstreamError(
+            url,
+            response.status_code,
+            float(retry_after) if retry_after and retry_after.isdigit() else None
+        )
+    return response
+
+
+async def fetch_json(_client: AsyncClient, url: str, params: dict = None, headers: dict = None) -> dict:
+    return (await fetch(_client, url, params, headers)).json()
+
+
+class DownloadTooLargeError(Exception):
+    def __init__(self, url: str, max_size: int):
+        super().__init__(f"{url} is larger than {max_size} bytes")
+        self.url: str = url
+        self.max_size: int = max_size
+
+
+async def download(
+        _client: AsyncClient,
+        url: str,
+        path: str | PathLike,
+        headers: dict = None,
+        max_size: int | None = None
+) -> int:
+    size = 0
+    async with _client.stream('GET', url, headers=headers) as response:
+        if not response.is_success:
+            raise UpstreamError(url, response.status_code)
+        if max_size is not None and int(response.headers.get('content-length', 0)) > max_size:
+            raise DownloadTooLargeError(url, max_size)
+        with open(path, 'wb') as file:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise DownloadTooLargeError(url, max_size)
+    return size
+
+
+async def warm_up(_client: AsyncClient, host: str) -> None:
+    try:
+        await _client.head(f"https://{host}/")
+    except HTTPError as e:
+        logger.warning("Failed to warm up connection to %s: %r", host, e)
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(NET_RETRY_MAX_BACKOFF, NET_RETRY_BACKOFF * 2 ** attempt))
 
 
 class NetClient:
     _httpx_client: AsyncClient
+    _host_limits: defaultdict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(NET_MAX_HOST_CONNECTIONS))
+    _breakers: defaultdict[str, CircuitBreaker] = defaultdict(CircuitBreaker)
+    _warm_up_task: asyncio.Task | None = None
 
     @classmethod
     def init_client(cls) -> None:
@@ -26,6 +187,9 @@ class NetClient:
 
     @classmethod
     async def close_client(cls) -> None:
+        if cls._warm_up_task is not None:
+            cls._warm_up_task.cancel()
+            cls._warm_up_task = None
         await close_client(cls._httpx_client)
 
     @classmethod
@@ -33,5 +197,58 @@ class NetClient:
         return cls._httpx_client
 
     @classmethod
-    async def fetch_json(cls, url: str, params: dict = None) -> dict:
-        return await fetch_json(cls._httpx_client, url, params)
+    def host_limit(cls, url: str) -> asyncio.Semaphore:
+        return cls._host_limits[URL(url).host]
+
+    @classmethod
+    def breaker(cls, url: str) -> CircuitBreaker:
+        return cls._breakers[URL(url).host]
+
+    @classmethod
+    async def warm_up(cls, hosts: list[str] = NET_WARM_UP_HOSTS) -> None:
+        await asyncio.gather(*(warm_up(cls._httpx_client, host) for host in hosts))
+
+    @classmethod
+    def start_warm_up(cls) -> None:
+        # in the background so startup doesn't wait on slow hosts, cancelled by close_client
+        cls._warm_up_task = asyncio.create_task(cls.warm_up(), name="NetClient.warm_up")
+
+    @classmethod
+    async def fetch_json(cls, url: str, params: dict = None, headers: dict = None) -> dict:
+        return (await cls.fetch(url, params, headers)).json()
+
+    @classmethod
+    async def fetch_text(cls, url: str, params: dict = None, headers: dict = None) -> str:
+        return (await cls.fetch(url, params, headers)).text
+
+    @classmethod
+    async def fetch_bytes(cls, url: str, params: dict = None, headers: dict = None) -> bytes:
+        return (await cls.fetch(url, params, headers)).content
+
+    @classmethod
+    async def fetch(cls, url: str, params: dict = None, headers: dict = None) -> Response:
+        breaker = cls.breaker(url)
+        for attempt in range(NET_RETRY_ATTEMPTS):
+            if not breaker.allow():
+                raise CircuitOpenError(url)
+            try:
+                async with cls.host_limit(url):
+                    result = await fetch(cls._httpx_client, url, params, headers)
+            except (TransportError, UpstreamError) as e:
+                if isinstance(e, UpstreamError) and not e.retryable:
+                    breaker.success()  # the upstream answered, the request itself is bad
+                    raise
+                breaker.failure()
+                if attempt + 1 >= NET_RETRY_ATTEMPTS:
+                    raise
+                delay = getattr(e, 'retry_after', None) or backoff(attempt)
+                logger.info("Retry %s in %.2fs after %r", url, delay, e)
+                await asyncio.sleep(min(delay, NET_RETRY_MAX_BACKOFF))
+            else:
+                breaker.success()
+                return result
+
+    @classmethod
+    async def download(cls, url: str, path: str | PathLike, headers: dict = None, max_size: int | None = None) -> int:
+        async with cls.host_limit(url):
+            return await download(cls._httpx_client, url, path, headers, max_size)
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, TypeVar
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+# same pickler PicklePersistence uses, so Message objects get the bot re-attached on load
+from telegram.ext._picklepersistence import _BotPickler, _BotUnpickler
+
+from .context import ChatData
+from .db import connect_sqlite
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar('T')
+
+USER = 'user'
+CHAT = 'chat'
+BOT = 'bot'
+CALLBACK = 'callback'
+CONVERSATION = 'conversation'
+
+
+# One row per user/chat in SQLite (WAL). Rows are only rewritten when their pickle changed, and user/chat
+# rows are loaded lazily on the first update for that user/chat, so neither startup nor flushes grow with
+# the size of the store. All SQLite work runs on a single background thread.
+class SQLitePersistence(BasePersistence[dict, ChatData, dict]):
+    def __init__(
+            self,
+            filepath: str | Path = 'data/pers.sqlite',
+            migrate_from: str | Path | None = None,
+            store_data: PersistenceInput | None = None,
+            update_interval: float = 60,
+    ):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath: Path = Path(filepath)
+        self.migrate_from: Path | None = Path(migrate_from) if migrate_from else None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._db: sqlite3.Connection | None = None
+        self._opened: asyncio.Future | None = None
+        self._loaded: dict[tuple[str, int], asyncio.Future] = {}
+        self._written: dict[tuple[str, str], bytes] = {}
+        self._conversations: dict[str, dict] = {}
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _dumps(self, obj: object) -> bytes:
+        buffer = io.BytesIO()
+        _BotPickler(self.bot, buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+        return buffer.getvalue()
+
+    def _loads(self, data: bytes) -> Any:
+        return _BotUnpickler(self.bot, io.BytesIO(data)).load()
+
+    def _connect(self) -> int:
+        self._db = connect_sqlite(self.filepath)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS persistence ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, key))"
+        )
+        return self._db.execute("SELECT COUNT(*) FROM persistence").fetchone()[0]
+
+    def _select(self, kind: str, key: str) -> bytes | None:
+        row = self._db.execute("SELECT value FROM persistence WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else None
+
+    def _upsert(self, rows: list[tuple[str, str, bytes]]) -> None:
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO persistence (kind, key, value) VALUES (?, ?, ?)", rows)
+
+    def _import(self, rows: list[tuple[str, str, bytes]]) -> bool:
+        # worker processes start together, only the first one to take the write lock on an empty store imports
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            if self._db.execute("SELECT COUNT(*) FROM persistence").fetchone()[0]:
+                return False
+            self._db.executemany("INSERT INTO persistence (kind, key, value) VALUES (?, ?, ?)", rows)
+        return True
+
+    def _delete(self, kind: str, key: str) -> None:
+        self._db.execute("DELETE FROM persistence WHERE kind = ? AND key = ?", (kind, key))
+
+    def _close(self) -> None:
+        if self._db is not None:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._db.close()
+            self._db = None
+
+    async def _open(self) -> None:
+        if self._opened is None:
+            self._opened = asyncio.ensure_future(self._do_open())
+        await asyncio.shield(self._opened)
+
+    async def _do_open(self) -> None:
+        count = await self._run(self._connect)
+        if not count and self.migrate_from and self.migrate_from.exists():
+            await self._migrate()
+
+    async def _migrate(self) -> None:
+        logger.warning("Migrating %s to %s", self.migrate_from, self.filepath)
+        # everything is migrated, whatever this process stores, a later run may store more
+        old = PicklePersistence(filepath=self.migrate_from)
+        old.set_bot(self.bot)
+        rows = [
+            *((USER, str(user_id), self._dumps(data)) for user_id, data in (await old.get_user_data() or {}).items()),
+            *((CHAT, str(chat_id), self._dumps(data)) for chat_id, data in (await old.get_chat_data() or {}).items()),
+            (BOT, '', self._dumps(await old.get_bot_data())),
+            *((CONVERSATION, name, self._dumps(data)) for name, data in (old.conversations or {}).items()),
+        ]
+        if callback_data := await old.get_callback_data():
+            rows.append((CALLBACK, '', self._dumps(callback_data)))
+        if not await self._run(self._import, rows):
+            return  # another worker was first
+        self.migrate_from.rename(self.migrate_from.with_suffix(self.migrate_from.suffix + '.migrated'))
+        logger.warning("Migrated %d rows from %s", len(rows), self.migrate_from)
+
+    async def _get(self, kind: str, key: str, default: Any = None) -> Any:
+        await self._open()
+        value = await self._run(self._select, kind, key)
+        if value is None:
+            return default
+        self._written[(kind, key)] = value
+        return self._loads(value)
+
+    async def _put(self, kind: str, key: str, data: object) -> None:
+        await self._open()
+        value = self._dumps(data)
+        if self._written.get((kind, key)) == value:
+            return
+        self._written[(kind, key)] = value
+        await self._run(self._upsert, [(kind, key, value)])
+
+    async def _drop(self, kind: str, key: str) -> None:
+        await self._open()
+        self._written.pop((kind, key), None)
+        await self._run(self._delete, kind, key)
+
+    async def _refresh(self, kind: str, key: int, data: dict | ChatData) -> None:
+        if (loaded := self._loaded.get((kind, key))) is None:
+            self._loaded[(kind, key)] = loaded = asyncio.ensure_future(self._load_into(kind, key, data))
+        await asyncio.shield(loaded)
+
+    async def _load_into(self, kind: str, key: int, data: dict | ChatData) -> None:
+        stored = await self._get(kind, str(key))
+        if stored is None:
+            return
+        if isinstance(data, dict):
+            data.update(stored)
+        else:
+            data.__dict__.update(stored.__dict__)
+
+    async def get_user_data(self) -> dict[int, dict]:
+        await self._open()
+        return {}
+
+    async def get_chat_data(self) -> dict[int, ChatData]:
+        await self._open()
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return await self._get(BOT, '', {})
+
+    async def get_callback_data(self) -> tuple[list[tuple[str, float, dict[str, Any]]], dict[str, str]] | None:
+        return await self._get(CALLBACK, '')
+
+    async def get_conversations(self, name: str) -> dict:
+        if name not in self._conversations:
+            self._conversations[name] = await self._get(CONVERSATION, name, {})
+        return self._conversations[name]
+
+    async def update_conversation(self, name: str, key: tuple[int | str, ...], new_state: object | None) -> None:
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        await self._put(CONVERSATION, name, conversations)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._put(USER, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: ChatData) -> None:
+        await self._put(CHAT, str(chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._put(BOT, '', data)
+
+    async def update_callback_data(self, data: tuple[list[tuple[str, float, dict[str, Any]]], dict[str, str]]) -> None:
+        await self._put(CALLBACK, '', data)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded.pop((CHAT, chat_id), None)
+        await self._drop(CHAT, str(chat_id))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded.pop((USER, user_id), None)
+        await self._drop(USER, str(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: ChatData) -> None:
+        await self._refresh(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._opened is None:
+            return
+        await self._run(self._close)
+        self._opened = None
+        self._loaded.clear()
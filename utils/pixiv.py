@@ -1,13 +1,39 @@
 from __future__ import annotations
 
+import asyncio
+import time
+from pathlib import Path
 from typing import Literal, TYPE_CHECKING
 
 from async_pixiv import PixivClient
-from async_pixiv.error import APIError
+from async_pixiv.error import APIError, OauthError
+
+from common import NET_HOST_OVERRIDES, NET_REPLAY_MODE, PIXIV_REFRESH_INTERVAL, PIXIV_RETRY_ATTEMPTS, PIXIV_TIMEOUT
+from .cache import PostCache
+from .logger import get_logger
+from .media import MediaCache
+from .net import backoff, wrap_transport
+from .transcode import Transcoder, ugoira_to_mp4
 
 if TYPE_CHECKING:
     from async_pixiv.model.illust import Illust
 
+logger = get_logger(__name__)
+
+pixiv_headers = {'Referer': 'https://www.pixiv.net/'}
+
+# an expired access token comes back as an APIError whose message mentions the OAuth process
+AUTH_ERRORS = ('oauth', 'invalid_grant', 'access token')
+
+
+def is_auth_error(error: Exception) -> bool:
+    if isinstance(error, OauthError):
+        return True
+    if getattr(getattr(error, 'response', None), 'status_code', None) == 401:
+        return True
+    text = f"{getattr(error, 'message', '')} {getattr(error, 'user_message', '')}".lower()
+    return any(i in text for i in AUTH_ERRORS)
+
 
 class PixivMedia:
     __slots__ = ('_url', '_thumb')
@@ -32,6 +58,10 @@ class PixivMedia:
         url = self._url.replace("img-original", "img-master").removesuffix(".jpg").removesuffix(".png")
         return url + "_master1200.jpg"
 
+    @property
+    def candidates(self) -> list[str]:
+        return [self._url, self.large]
+
 
 class Pixiv:
     __slots__ = ('_illust',)
@@ -39,6 +69,10 @@ class Pixiv:
     def __init__(self, illust: Illust):
         self._illust: Illust = illust
 
+    @property
+    def id(self) -> int:
+        return self._illust.id
+
     @property
     def url(self) -> str:
         return str(self._illust.link).rstrip('/')
@@ -98,29 +132,70 @@ class Pixiv:
             ]
 
 
+def wrap_pixiv_transport(client: PixivClient) -> None:
+    # async_pixiv takes no transport argument, so wrap the one its httpx client built. That is private to
+    # async_pixiv, if it has moved the client keeps its stock transport
+    http = getattr(client, '_client', None)
+    transport = getattr(http, '_transport', None)
+    try:
+        from async_pixiv.client._response import Response
+    except ImportError:
+        Response = None
+    if transport is None or Response is None:
+        logger.warning("Can't wrap the async_pixiv transport, Pixiv requests bypass the host overrides and replay")
+        return
+    http._transport = wrap_transport(transport, Response)
+
+
 class _ProcessPixiv:
     _client: PixivClient
+    _token: str
+    _refresh_lock: asyncio.Lock
+    _refreshed_at: float = 0
+    _refresher: asyncio.Task | None = None
 
     @classmethod
     async def init_client(cls, token: str) -> None:
         cls._client = PixivClient()
-        await cls._client.login_with_token(token)
+        if NET_HOST_OVERRIDES or NET_REPLAY_MODE:
+            wrap_pixiv_transport(cls._client)
         cls._token = token
+        cls._refresh_lock = asyncio.Lock()
+        await cls.refresh_token()
+        cls._refresher = asyncio.create_task(cls._refresh_loop(), name="ProcessPixiv.refresh_loop")
 
     @classmethod
     async def close_client(cls) -> None:
+        if cls._refresher:
+            cls._refresher.cancel()
         await cls._client.close()
 
     @classmethod
     async def refresh_token(cls):
-        await cls._client.login_with_token(cls._token)
+        requested_at = time.monotonic()
+        async with cls._refresh_lock:
+            if cls._refreshed_at > requested_at:  # refreshed by someone else while waiting for the lock
+                return
+            await cls._client.login_with_token(cls._client.refresh_token or cls._token)
+            cls._refreshed_at = time.monotonic()
+
+    @classmethod
+    async def _refresh_loop(cls):
+        while True:
+            await asyncio.sleep(cls._refreshed_at + PIXIV_REFRESH_INTERVAL - time.monotonic())
+            try:
+                await cls.refresh_token()
+            except Exception as e:
+                logger.warning("Failed to refresh pixiv token: %r", e)
+                await asyncio.sleep(60)
 
 
 class ProcessPixiv(_ProcessPixiv):
-    __slots__ = ('_url', '_illust')
+    __slots__ = ('_url', '_refresh', '_illust')
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False):
         self._url: str = url
+        self._refresh: bool = refresh
 
     async def __aenter__(self):
         self._illust = await self._fetch_illust()
@@ -131,11 +206,57 @@ class ProcessPixiv(_ProcessPixiv):
 
     async def _fetch_illust(self) -> Illust:
         illust_id = self._parse_illust_id()
-        try:
-            return (await self._client.ILLUST.detail(illust_id)).illust
-        except APIError:
-            await self.refresh_token()
-            return (await self._client.ILLUST.detail(illust_id)).illust  # TODO use retry here
+        return await PostCache.fetch(
+            'pixiv',
+            str(illust_id),
+            lambda: self._fetch_illust_detail(illust_id),
+            refresh=self._refresh
+        )
+
+    async def _fetch_illust_detail(self, illust_id: int) -> Illust:
+        # async_pixiv retries internally without a bound, so each attempt gets its own timeout
+        for attempt in range(PIXIV_RETRY_ATTEMPTS):
+            try:
+                async with asyncio.timeout(PIXIV_TIMEOUT):
+                    return (await self._client.ILLUST.detail(illust_id)).illust
+            except (APIError, OauthError, TimeoutError) as e:
+                auth = is_auth_error(e)
+                if not auth and not isinstance(e, TimeoutError):
+                    raise  # deleted, private and the like won't get better with a new token
+                if attempt + 1 >= PIXIV_RETRY_ATTEMPTS:
+                    raise
+                logger.warning("Failed to fetch illust %s: %r, retrying", illust_id, e)
+                if auth:
+                    await self.refresh_token()
+                await asyncio.sleep(backoff(attempt))
 
     def _parse_illust_id(self) -> int:
         return int(self._url.split("/")[-1])
+
+    @classmethod
+    async def fetch_ugoira_frames(cls, illust_id: int) -> tuple[str, list[tuple[str, int]]]:
+        async def fetch():
+            async with asyncio.timeout(PIXIV_TIMEOUT):
+                return (await cls._client.ILLUST.ugoira_metadata(illust_id)).metadata
+
+        metadata = await PostCache.fetch('pixiv-ugoira', str(illust_id), fetch)
+        zip_url = str(metadata.zip_url.medium).replace('600x600', '1920x1080')
+        return zip_url, [(frame.file, frame.delay) for frame in metadata.frames]
+
+
+class ProcessUgoira:
+    __slots__ = ('_illust_id',)
+
+    def __init__(self, illust_id: int):
+        self._illust_id: int = illust_id
+
+    async def __aenter__(self) -> Path:
+        return await MediaCache.render(f'ugoira:{self._illust_id}', '.mp4', self._render)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def _render(self, output: str) -> None:
+        zip_url, frames = await ProcessPixiv.fetch_ugoira_frames(self._illust_id)
+        zip_path = await MediaCache.fetch(zip_url, '.zip', headers=pixiv_headers)
+        await Transcoder.run(ugoira_to_mp4, str(zip_path), frames, output)
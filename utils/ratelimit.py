@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import itertools
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from common import (SEND_CHAT_BURST, SEND_CHAT_RATE, SEND_GLOBAL_RATE, SEND_GROUP_BURST, SEND_GROUP_RATE,
+                    SEND_MAX_RETRIES)
+from .logger import get_logger
+from .metrics import RETRY_AFTER, SEND_QUEUE_DEPTH, SEND_WAIT
+
+logger = get_logger(__name__)
+
+PRIORITY_INLINE = 0
+PRIORITY_REPLY = 1
+PRIORITY_FORWARD = 2
+
+INLINE_ENDPOINTS = {'answerInlineQuery', 'answerCallbackQuery'}
+FORWARD_ENDPOINTS = {'copyMessage', 'copyMessages', 'forwardMessage', 'forwardMessages'}
+MESSAGE_ENDPOINTS = {
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendAnimation', 'sendDocument', 'sendAudio', 'sendVoice',
+    'sendVideoNote', 'sendSticker', 'sendMediaGroup', 'sendLocation', 'sendVenue', 'sendContact', 'sendPoll',
+    'sendDice', 'sendPaidMedia', *FORWARD_ENDPOINTS
+}
+MAX_CHAT_BUCKETS = 4096
+
+
+def send_priority(endpoint: str) -> int:
+    if endpoint in INLINE_ENDPOINTS:
+        return PRIORITY_INLINE
+    if endpoint in FORWARD_ENDPOINTS:
+        return PRIORITY_FORWARD
+    return PRIORITY_REPLY
+
+
+def message_weight(endpoint: str, data: dict[str, Any]) -> int:
+    # how many messages the call counts as towards Telegram's limits
+    if endpoint not in MESSAGE_ENDPOINTS:
+        return 0
+    if endpoint == 'sendMediaGroup':
+        return len(data.get('media') or ()) or 1
+    if endpoint in ('copyMessages', 'forwardMessages'):
+        return len(data.get('message_ids') or ()) or 1
+    return 1
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+        self.paused_until: float = 0
+
+    def delay(self, amount: int, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, self.paused_until - now, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def pause(self, delay: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def consume(self, amount: int) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class _Waiter:
+    __slots__ = ('chat_id', 'weight', 'priority', 'future', 'enqueued')
+
+    def __init__(self, chat_id: int | str | None, weight: int, priority: int, future: asyncio.Future):
+        self.chat_id: int | str | None = chat_id
+        self.weight: int = weight
+        self.priority: int = priority
+        self.future: asyncio.Future = future
+        self.enqueued: float = time.monotonic()
+
+
+# Every Bot API call passes through here. Calls that send messages take tokens from a global bucket and one per
+# chat (private chats and groups/channels have different limits), weighted by the number of messages they
+# produce. Calls wait in priority order: inline answers, then replies, then channel forwards; a call blocked on
+# the global limit holds back lower priorities, one blocked on its chat doesn't. A RetryAfter pauses the chat
+# it came from (or every call, if it had no chat) for the time Telegram asks for, then the call is retried.
+# Buckets are per process: with several workers each one gets a share of the global rate, and a chat that
+# receives forwards (a channel fed from chats any worker may handle) gets a share of the group limit too.
+class SendLimiter(BaseRateLimiter[dict]):
+    def __init__(
+            self,
+            rate: float = SEND_GLOBAL_RATE,
+            chat_rate: float = SEND_CHAT_RATE,
+            chat_burst: int = SEND_CHAT_BURST,
+            group_rate: float = SEND_GROUP_RATE,
+            group_burst: int = SEND_GROUP_BURST,
+            max_retries: int = SEND_MAX_RETRIES,
+            workers: int = 1
+    ):
+        self._global: TokenBucket = TokenBucket(rate, max(1, int(rate)))
+        self._chat_limit: tuple[float, int] = (chat_rate, chat_burst)
+        self._group_limit: tuple[float, int] = (group_rate, group_burst)
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._workers: int = workers
+        self._shared: set[int | str] = set()  # chats forwarded to, whose limit every worker shares
+        self._max_retries: int = max_retries
+        self._waiting: list[tuple[int, int, _Waiter]] = []  # sorted by priority, then arrival
+        self._seq = itertools.count()
+        self._paused_until: float = 0
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    async def initialize(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch_loop(), name="SendLimiter.dispatch")
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+
+    async def process_request(
+            self,
+            callback: Callable[..., Coroutine[Any, Any, bool | dict[str, Any] | list[dict[str, Any]]]],
+            args: Any,
+            kwargs: dict[str, Any],
+            endpoint: str,
+            data: dict[str, Any],
+            rate_limit_args: dict | None
+    ) -> bool | dict[str, Any] | list[dict[str, Any]]:
+        priority = (rate_limit_args or {}).get('priority', send_priority(endpoint))
+        weight = message_weight(endpoint, data)
+        seq = next(self._seq)  # a retried call keeps its place in line
+        if self._workers > 1 and endpoint in FORWARD_ENDPOINTS:
+            self._share(data.get('chat_id'))
+        for attempt in range(self._max_retries + 1):
+            await self._acquire(seq, priority, data.get('chat_id'), weight)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                RETRY_AFTER.inc()
+                if attempt >= self._max_retries:
+                    raise
+                # an int, or a timedelta once PTB_TIMEDELTA is set
+                retry_after = e.retry_after
+                delay = (retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after) + 0.1
+                logger.warning("Flood control on %s to %s, pausing for %.1fs", endpoint, data.get('chat_id'), delay)
+                if chat := self._bucket(data.get('chat_id')):
+                    chat.pause(delay)
+                else:
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._wakeup.set()
+
+    def _share(self, chat_id: int | str | None) -> None:
+        if chat_id is None or chat_id in self._shared:
+            return
+        self._shared.add(chat_id)
+        if bucket := self._chats.get(chat_id):
+            bucket.rate /= self._workers
+            bucket.capacity = max(1, bucket.capacity // self._workers)
+            bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    def _bucket(self, chat_id: int | str | None) -> TokenBucket | None:
+        if chat_id is None:
+            return None
+        if (bucket := self._chats.get(chat_id)) is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                self._chats = {k: v for k, v in self._chats.items() if v.delay(v.capacity, now) > 0}
+            private = isinstance(chat_id, int) and chat_id > 0
+            rate, burst = self._chat_limit if private else self._group_limit
+            if chat_id in self._shared:
+                rate, burst = rate / self._workers, max(1, burst // self._workers)
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _delay(self, waiter: _Waiter, now: float) -> tuple[float, float]:
+        chat = self._bucket(waiter.chat_id)
+        global_delay = self._global.delay(waiter.weight, now) if waiter.weight else 0.0
+        return global_delay, chat.delay(waiter.weight, now) if chat else 0.0
+
+    def _take(self, waiter: _Waiter) -> None:
+        self._global.consume(waiter.weight)
+        if chat := self._bucket(waiter.chat_id):
+            chat.consume(waiter.weight)
+
+    async def _acquire(self, seq: int, priority: int, chat_id: int | str | None, weight: int) -> None:
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(chat_id, weight, priority, loop.create_future())
+        now = time.monotonic()
+        if not self._waiting and now >= self._paused_until:
+            if self._delay(waiter, now) == (0.0, 0.0):
+                self._take(waiter)
+                SEND_WAIT.labels(priority).observe(0)
+                return
+        bisect.insort(self._waiting, (priority, seq, waiter), key=lambda entry: entry[:2])
+        SEND_QUEUE_DEPTH.set(len(self._waiting))
+        self._wakeup.set()
+        await waiter.future
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            delay = self._dispatch()
+            self._wakeup.clear()
+            try:
+                async with asyncio.timeout(delay):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+
+    def _dispatch(self) -> float | None:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        next_delay = None
+        held = False  # a higher priority call is waiting on the global limit
+        for entry in list(self._waiting):
+            waiter = entry[2]
+            if waiter.future.done():  # cancelled while waiting
+                self._waiting.remove(entry)
+                continue
+            if held and waiter.weight:
+                continue
+            global_delay, chat_delay = self._delay(waiter, now)
+            if global_delay or chat_delay:
+                held = held or global_delay > 0
+                wait = max(global_delay, chat_delay)
+                next_delay = wait if next_delay is None else min(next_delay, wait)
+                continue
+            self._take(waiter)
+            self._waiting.remove(entry)
+            SEND_WAIT.labels(waiter.priority).observe(now - waiter.enqueued)
+            waiter.future.set_result(None)
+        SEND_QUEUE_DEPTH.set(len(self._waiting))
+        return next_delay
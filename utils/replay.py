@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+from httpx import AsyncBaseTransport, ConnectError, Request, Response
+
+from common import NET_REPLAY_DB, NET_REPLAY_MODE, NET_REPLAY_SPEED
+from .db import connect_sqlite
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+SKIP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'set-cookie'}
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml', 'text/',
+                      'application/vnd.apple.mpegurl', 'application/x-mpegurl')
+
+
+def request_key(request: Request) -> str:
+    url = request.url.copy_with(params=sorted(request.url.params.multi_items()))
+    key = f"{request.method} {url}"
+    if byte_range := request.headers.get('range'):
+        key += f" {byte_range}"
+    return key
+
+
+def compressible(headers: list[tuple[str, str]]) -> bool:
+    headers = {name.lower(): value for name, value in headers}
+    if headers.get('content-encoding'):
+        return False
+    return headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES)
+
+
+# Responses are stored by method, url (query sorted) and range header. Bodies are kept raw, exactly as they came
+# off the wire, deduplicated by hash and zlib compressed when they are text.
+class ReplayStore:
+    _db: sqlite3.Connection | None = None
+
+    @classmethod
+    def init_db(cls, path: str = NET_REPLAY_DB) -> None:
+        cls._db = connect_sqlite(path)
+        cls._db.execute(
+            "CREATE TABLE IF NOT EXISTS response ("
+            "key TEXT PRIMARY KEY, status INTEGER NOT NULL, headers TEXT NOT NULL, body TEXT NOT NULL, "
+            "elapsed REAL NOT NULL, recorded REAL NOT NULL)"
+        )
+        cls._db.execute(
+            "CREATE TABLE IF NOT EXISTS body (hash TEXT PRIMARY KEY, compressed INTEGER NOT NULL, data BLOB NOT NULL)"
+        )
+
+    @classmethod
+    def close_db(cls) -> None:
+        if cls._db is not None:
+            cls._db.close()
+            cls._db = None
+
+    @classmethod
+    def get(cls, key: str) -> tuple[int, list[tuple[str, str]], bytes, float] | None:
+        if cls._db is None:
+            cls.init_db()
+        row = cls._db.execute(
+            "SELECT status, headers, compressed, data, elapsed FROM response JOIN body ON body = hash WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, headers, compressed, data, elapsed = row
+        return status, [tuple(i) for i in json.loads(headers)], zlib.decompress(data) if compressed else data, elapsed
+
+    @classmethod
+    def set(cls, key: str, status: int, headers: list[tuple[str, str]], content: bytes, elapsed: float) -> None:
+        if cls._db is None:
+            cls.init_db()
+        digest = hashlib.sha256(content).hexdigest()
+        if not cls._db.execute("SELECT 1 FROM body WHERE hash = ?", (digest,)).fetchone():
+            compressed = compressible(headers)
+            cls._db.execute(
+                "INSERT OR IGNORE INTO body (hash, compressed, data) VALUES (?, ?, ?)",
+                (digest, compressed, zlib.compress(content) if compressed else content)
+            )
+        cls._db.execute(
+            "INSERT OR REPLACE INTO response (key, status, headers, body, elapsed, recorded) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, status, json.dumps(headers), digest, elapsed, time.time())
+        )
+
+
+class ReplayTransport(AsyncBaseTransport):
+    # record: pass requests through and store the responses; replay: answer from the store only, never the network
+    def __init__(
+            self,
+            transport: AsyncBaseTransport,
+            mode: str = NET_REPLAY_MODE,
+            speed: float = NET_REPLAY_SPEED,
+            response_class: type[Response] = Response
+    ):
+        self._transport: AsyncBaseTransport = transport
+        self._mode: str = mode
+        self._speed: float = speed
+        self._response_class: type[Response] = response_class
+
+    async def handle_async_request(self, request: Request) -> Response:
+        key = request_key(request)
+        if self._mode == 'replay':
+            return await self._replay(request, key)
+        start = time.perf_counter()
+        response = await self._transport.handle_async_request(request)
+        try:
+            content = b''.join([chunk async for chunk in response.stream])
+        finally:
+            await response.aclose()
+        headers = [(name, value) for name, value in response.headers.multi_items() if name not in SKIP_HEADERS]
+        ReplayStore.set(key, response.status_code, headers, content, time.perf_counter() - start)
+        return self._response_class(response.status_code, headers=headers, content=content, request=request)
+
+    async def _replay(self, request: Request, key: str) -> Response:
+        if (recorded := ReplayStore.get(key)) is None:
+            logger.warning("No recorded response for %s", key)
+            raise ConnectError(f"No recorded response for {key}", request=request)
+        status, headers, content, elapsed = recorded
+        if self._speed > 0:
+            await asyncio.sleep(elapsed / self._speed)
+        return self._response_class(status, headers=headers, content=content, request=request)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
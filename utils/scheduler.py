@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Coroutine
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from common import (UPDATE_BUSY_DEPTH, UPDATE_CHAT_CONCURRENCY, UPDATE_CHAT_QUEUE_SIZE, UPDATE_CONCURRENCY,
+                    UPDATE_FAST_CONCURRENCY, UPDATE_QUEUE_SIZE)
+from .logger import get_logger
+from .metrics import UPDATE_QUEUE_DEPTH, UPDATE_WAIT, UPDATES_IN_FLIGHT, UPDATES_REJECTED
+
+logger = get_logger(__name__)
+
+
+def is_fast(update: object) -> bool:
+    # inline and callback queries are short and someone is watching a spinner, they never queue behind links
+    if not isinstance(update, Update):
+        return True
+    return bool(update.inline_query or update.callback_query or update.chosen_inline_result)
+
+
+def update_chat_id(update: Update) -> int:
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.effective_user.id if update.effective_user else 0
+
+
+# Message updates run at most `concurrency` at a time and `chat_concurrency` per chat. Updates over the limits
+# wait in a queue per chat, and freed slots go round-robin over the chats that are waiting, so one chat
+# sending many links only delays itself. A chat is told once its queue reaches `busy_depth`, and further
+# updates are dropped while its queue or the total queue is full.
+class UpdateScheduler(BaseUpdateProcessor):
+    def __init__(
+            self,
+            concurrency: int = UPDATE_CONCURRENCY,
+            chat_concurrency: int = UPDATE_CHAT_CONCURRENCY,
+            fast_concurrency: int = UPDATE_FAST_CONCURRENCY,
+            queue_size: int = UPDATE_QUEUE_SIZE,
+            chat_queue_size: int = UPDATE_CHAT_QUEUE_SIZE,
+            busy_depth: int = UPDATE_BUSY_DEPTH
+    ):
+        # PTB's own semaphore bounds everything admitted; the queues below reject before it is reached
+        super().__init__(concurrency + fast_concurrency + queue_size)
+        self._concurrency: int = concurrency
+        self._chat_concurrency: int = chat_concurrency
+        self._queue_size: int = queue_size
+        self._chat_queue_size: int = chat_queue_size
+        self._busy_depth: int = busy_depth
+        self._fast: asyncio.Semaphore = asyncio.Semaphore(fast_concurrency)
+        self._fast_waiting: int = 0
+        self._queues: dict[int, deque[asyncio.Future]] = {}
+        self._ready: deque[int] = deque()  # chats with queued updates, in round-robin order
+        self._running: dict[int, int] = {}
+        self._total_running: int = 0
+        self._queued: int = 0
+        self._rejected: int = 0
+        self._notices: set[asyncio.Task] = set()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for task in self._notices:
+            task.cancel()
+
+    async def do_process_update(self, update: object, coroutine: Coroutine[Any, Any, Any]) -> None:
+        if is_fast(update):
+            await self._run_fast(coroutine)
+            return
+        chat_id = update_chat_id(update)
+        try:
+            granted = await self._acquire(update, chat_id)
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        if not granted:
+            coroutine.close()
+            return
+        try:
+            with UPDATES_IN_FLIGHT.track_inprogress():
+                await coroutine
+        finally:
+            self._release(chat_id)
+
+    async def _run_fast(self, coroutine: Coroutine[Any, Any, Any]) -> None:
+        start = time.perf_counter()
+        self._fast_waiting += 1
+        UPDATE_QUEUE_DEPTH.labels('fast').set(self._fast_waiting)
+        try:
+            await self._fast.acquire()
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            self._fast_waiting -= 1
+            UPDATE_QUEUE_DEPTH.labels('fast').set(self._fast_waiting)
+        UPDATE_WAIT.labels('fast').observe(time.perf_counter() - start)
+        try:
+            with UPDATES_IN_FLIGHT.track_inprogress():
+                await coroutine
+        finally:
+            self._fast.release()
+
+    def admits(self, update: object) -> bool:
+        # whether do_process_update would run or queue the update rather than drop it
+        if is_fast(update):
+            return True
+        chat_id = update_chat_id(update)
+        return self._can_start(chat_id) or not self._is_full(chat_id)
+
+    def _can_start(self, chat_id: int) -> bool:
+        return (self._total_running < self._concurrency and self._running.get(chat_id, 0) < self._chat_concurrency
+                and chat_id not in self._queues)
+
+    def _is_full(self, chat_id: int) -> bool:
+        queue = self._queues.get(chat_id)
+        return self._queued >= self._queue_size or bool(queue and len(queue) >= self._chat_queue_size)
+
+    async def _acquire(self, update: Update, chat_id: int) -> bool:
+        if self._can_start(chat_id):
+            self._start(chat_id)
+            UPDATE_WAIT.labels('chat').observe(0)
+            return True
+        if self._is_full(chat_id):
+            self._rejected += 1
+            UPDATES_REJECTED.inc()
+            logger.info("Drop update %s from chat %s, queue is full", update.update_id, chat_id)
+            self._notify(update, "🚫 Too many pending requests, please try again later.")
+            return False
+        if (queue := self._queues.get(chat_id)) is None:
+            queue = self._queues[chat_id] = deque()
+            self._ready.append(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self._queued += 1
+        UPDATE_QUEUE_DEPTH.labels('chat').set(self._queued)
+        if len(queue) == self._busy_depth:
+            self._notify(update, f"⏳ Busy, your request is queued ({len(queue) - 1} ahead).")
+        start = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(chat_id)  # granted a slot just before being cancelled
+            else:
+                self._discard(chat_id, future)
+            raise
+        UPDATE_WAIT.labels('chat').observe(time.perf_counter() - start)
+        return True
+
+    def _start(self, chat_id: int) -> None:
+        self._running[chat_id] = self._running.get(chat_id, 0) + 1
+        self._total_running += 1
+
+    def _release(self, chat_id: int) -> None:
+        self._total_running -= 1
+        self._running[chat_id] -= 1
+        if not self._running[chat_id]:
+            del self._running[chat_id]
+        self._dispatch()
+
+    def _discard(self, chat_id: int, future: asyncio.Future) -> None:
+        if (queue := self._queues.get(chat_id)) is None or future not in queue:
+            return  # already taken off the queue by _dispatch
+        queue.remove(future)
+        self._queued -= 1
+        UPDATE_QUEUE_DEPTH.labels('chat').set(self._queued)
+        if not queue:
+            del self._queues[chat_id]
+            self._ready.remove(chat_id)
+
+    def _dispatch(self) -> None:
+        while self._total_running < self._concurrency and self._ready:
+            for _ in range(len(self._ready)):
+                chat_id = self._ready[0]
+                self._ready.rotate(-1)
+                if self._running.get(chat_id, 0) < self._chat_concurrency:
+                    break
+            else:
+                break  # every waiting chat is at its own limit
+            queue = self._queues[chat_id]
+            future = queue.popleft()
+            self._queued -= 1
+            if not queue:
+                del self._queues[chat_id]
+                self._ready.remove(chat_id)
+            if future.cancelled():
+                continue
+            self._start(chat_id)
+            future.set_result(None)
+        UPDATE_QUEUE_DEPTH.labels('chat').set(self._queued)
+
+    def _notify(self, update: Update, text: str) -> None:
+        if not (message := update.effective_message):
+            return
+        task = asyncio.create_task(message.reply_text(text, reply_to_message_id=message.message_id))
+        self._notices.add(task)
+        task.add_done_callback(self._notice_done)
+
+    def _notice_done(self, task: asyncio.Task) -> None:
+        self._notices.discard(task)
+        if not task.cancelled() and (error := task.exception()):
+            logger.warning("Failed to send queue notice: %r", error)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'running': self._total_running,
+            'queued': self._queued,
+            'chats': len(self._queues),
+            'rejected': self._rejected,
+        }
@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import ssl
+import struct
+import time
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any, Callable, TYPE_CHECKING
+
+import tornado.web
+from telegram import Bot, Update
+from tornado.httpserver import HTTPServer
+
+from common import BOT_API_URL, BOT_TOKEN, WEBHOOK_QUEUE, WEBHOOK_QUEUE_INFLIGHT, WORKER_INDEX, WORKERS
+from .logger import get_logger
+from .scheduler import UpdateScheduler
+from .webhookqueue import WebhookQueue
+
+if TYPE_CHECKING:
+    from multiprocessing.process import BaseProcess
+
+    from telegram.ext import Application
+
+logger = get_logger(__name__)
+
+FRAME_HEADER = struct.Struct('>I')
+SUPERVISE_INTERVAL = 1
+PURGE_INTERVAL = 600
+STOP_TIMEOUT = 30
+
+
+def update_key(data: dict[str, Any]) -> int:
+    # the chat the update belongs to, or its sender when it has none (inline queries), like UpdateScheduler
+    for name, value in data.items():
+        if name == 'update_id' or not isinstance(value, dict):
+            continue
+        if isinstance(chat := value.get('chat'), dict):
+            return chat['id']
+        if isinstance(message := value.get('message'), dict) and isinstance(chat := message.get('chat'), dict):
+            return chat['id']
+        if isinstance(user := value.get('from') or value.get('user'), dict):
+            return user['id']
+    return 0
+
+
+def shard_of(data: dict[str, Any], shards: int) -> int:
+    return update_key(data) % shards
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes | None:
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        return await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def write_frame(writer: asyncio.StreamWriter, body: bytes) -> None:
+    writer.write(FRAME_HEADER.pack(len(body)) + body)
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, front: ShardFront, secret_token: str | None) -> None:
+        self.front: ShardFront = front
+        self.secret_token: str | None = secret_token
+
+    async def post(self) -> None:
+        if self.secret_token and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+        try:
+            data = json.loads(self.request.body)
+            update_id = int(data['update_id'])
+        except (ValueError, TypeError, KeyError):
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+        if self.front.durable:
+            try:
+                stored = WebhookQueue.append(update_id, update_key(data), self.request.body)
+            except sqlite3.Error as e:
+                logger.error("Failed to store update %s: %r", update_id, e)
+                raise tornado.web.HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+            if stored:
+                self.front.notify(shard_of(data, self.front.workers))
+            else:
+                logger.info("Ignoring update %s, it was delivered before", update_id)
+            self.set_status(HTTPStatus.OK)
+            return
+        try:
+            await self.front.dispatch(shard_of(data, self.front.workers), self.request.body)
+        except ConnectionError as e:
+            # not acknowledged, so Telegram delivers it again once the worker is back
+            logger.warning("Failed to hand update %s to a worker: %r", update_id, e)
+            raise tornado.web.HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.set_status(HTTPStatus.OK)
+
+
+# The front process only checks the secret token, reads the chat id out of the raw update and passes the body
+# on to one of `workers` processes, picked by chat id, so every update of a chat goes to the same worker in
+# the order it arrived. Workers run the whole application (parsing, handlers, persistence) and are restarted
+# if they exit; chat data stays with the worker that owns the chat (user and bot data are not persisted, see
+# build_application), caches are shared through SQLite.
+# When `durable`, the front stores the update in WebhookQueue and answers Telegram right away; the socket only
+# wakes the worker up, which reads its updates from the queue, so nothing acknowledged is lost if it dies.
+class ShardFront:
+    def __init__(self, target: Callable[[socket.socket], None], workers: int, durable: bool = False):
+        self.workers: int = workers
+        self.durable: bool = durable
+        self._target: Callable[[socket.socket], None] = target
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: list[BaseProcess | None] = [None] * workers
+        self._writers: list[asyncio.StreamWriter | None] = [None] * workers
+        self._locks: list[asyncio.Lock] = [asyncio.Lock() for _ in range(workers)]
+
+    async def start(self) -> None:
+        for index in range(self.workers):
+            await self._spawn(index)
+
+    async def _spawn(self, index: int) -> None:
+        front, back = socket.socketpair()
+        os.environ['WORKER_INDEX'] = str(index)  # read by common in the worker
+        process = self._context.Process(target=self._target, args=(back,), name=f"worker-{index}")
+        process.start()
+        back.close()
+        _, writer = await asyncio.open_connection(sock=front)
+        self._processes[index], self._writers[index] = process, writer
+        logger.info("Started worker %d, pid %s", index, process.pid)
+
+    async def dispatch(self, index: int, body: bytes) -> None:
+        async with self._locks[index]:  # drain() can't be awaited by several writers at once
+            if (writer := self._writers[index]) is None or writer.is_closing():
+                raise ConnectionResetError(f"worker {index} is not running")
+            write_frame(writer, body)
+            await writer.drain()
+
+    def notify(self, index: int) -> None:
+        # a worker that is down catches up from the queue once restarted
+        if (writer := self._writers[index]) is not None and not writer.is_closing():
+            write_frame(writer, b'')
+
+    async def supervise(self) -> None:
+        purged = time.monotonic()
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            if self.durable and time.monotonic() - purged > PURGE_INTERVAL:
+                WebhookQueue.purge()
+                purged = time.monotonic()
+            for index, process in enumerate(self._processes):
+                if process is not None and process.exitcode is not None:
+                    logger.warning("Worker %d exited with %s, restarting it", index, process.exitcode)
+                    self._writers[index].close()
+                    await self._spawn(index)
+
+    async def stop(self) -> None:
+        for writer in self._writers:
+            if writer is not None and not writer.is_closing():
+                writer.write_eof()  # workers stop once they have read everything
+        for index, process in enumerate(self._processes):
+            await asyncio.to_thread(process.join, STOP_TIMEOUT)
+            if process.exitcode is None:
+                logger.warning("Worker %d did not stop in %ss, terminating it", index, STOP_TIMEOUT)
+                process.terminate()
+        for writer in self._writers:
+            writer.close()
+
+
+async def serve_front(
+        target: Callable[[socket.socket], None],
+        workers: int,
+        listen: str,
+        port: int,
+        webhook_url: str | None,
+        secret_token: str | None = None,
+        key: str | None = None,
+        cert: str | None = None,
+        url_path: str = '',
+        durable: bool = False
+) -> None:
+    ssl_ctx = None
+    if key and cert:
+        ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_ctx.load_cert_chain(cert, key)
+    if durable:
+        WebhookQueue.init_db()
+        logger.warning("%d webhook updates left from the last run", WebhookQueue.backlog())
+    front = ShardFront(target, workers, durable)
+    await front.start()
+    app = tornado.web.Application([
+        (rf"/?{url_path.strip('/')}", WebhookHandler, {'front': front, 'secret_token': secret_token})
+    ])
+    server = HTTPServer(app, ssl_options=ssl_ctx)
+    server.listen(port, listen)
+    async with Bot(BOT_TOKEN, base_url=BOT_API_URL) as bot:
+        await bot.set_webhook(
+            url=webhook_url or f"{'https' if ssl_ctx else 'http'}://{listen}:{port}/{url_path.strip('/')}",
+            certificate=Path(cert) if cert else None,
+            secret_token=secret_token,
+        )
+    logger.warning("Webhook front listening on %s:%s with %d workers", listen, port, workers)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    supervisor = asyncio.create_task(front.supervise(), name="ShardFront.supervise")
+    await stopped.wait()
+    supervisor.cancel()
+    server.stop()
+    await server.close_all_connections()
+    await front.stop()
+    WebhookQueue.close_db()
+
+
+async def serve_worker(application: Application, sock: socket.socket) -> None:
+    # the front handles signals and stops the workers by closing their socket
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    reader, _ = await asyncio.open_connection(sock=sock)
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            if WEBHOOK_QUEUE:
+                await consume_queue(application, reader)
+            else:
+                await consume_socket(application, reader)
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    WebhookQueue.close_db()  # after stop(), which waits for the updates still being handled
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def parse_update(application: Application, body: bytes) -> Update | None:
+    try:
+        return Update.de_json(json.loads(body), application.bot)
+    except Exception as e:
+        logger.error("Dropping an update that could not be parsed: %r", e)
+        return None
+
+
+async def consume_socket(application: Application, reader: asyncio.StreamReader) -> None:
+    while (body := await read_frame(reader)) is not None:
+        if update := parse_update(application, body):
+            await application.update_queue.put(update)
+
+
+async def consume_queue(application: Application, reader: asyncio.StreamReader) -> None:
+    # updates go to the update processor in queue order and are marked done once it took them, so a worker that
+    # dies mid-update handles it again after the restart. Updates the scheduler has no room for stay in the
+    # queue, along with the later ones of their chat, until a handled update frees some
+    WebhookQueue.init_db()
+    processor = application.update_processor
+    slots = asyncio.Semaphore(WEBHOOK_QUEUE_INFLIGHT)
+    wakeup = asyncio.Event()
+    inflight: set[int] = set()
+    last_seq = 0
+    retry_from = 0
+
+    async def handle(seq: int, update: Update) -> None:
+        nonlocal retry_from
+        started = False
+
+        async def process() -> None:
+            nonlocal started
+            started = True
+            await application.process_update(update)
+
+        try:
+            await processor.process_update(update, process())
+        finally:
+            if started:
+                WebhookQueue.done(seq)
+            else:  # dropped by the scheduler after all, fetch it again
+                retry_from = min(retry_from or seq, seq)
+            inflight.discard(seq)
+            slots.release()
+            wakeup.set()
+
+    def admits(update: Update) -> bool:
+        return not isinstance(processor, UpdateScheduler) or processor.admits(update)
+
+    async def read_wakeups() -> None:
+        while await read_frame(reader) is not None:
+            wakeup.set()
+        wakeup.set()
+
+    reading = asyncio.create_task(read_wakeups(), name="WebhookQueue.wakeups")
+    try:
+        while not reading.done():
+            wakeup.clear()
+            after = min(last_seq, retry_from - 1) if retry_from else last_seq
+            retry_from = 0
+            full: set[int] = set()  # keys (chats) held back in this pass
+            dispatched = 0
+            while rows := WebhookQueue.pending(WORKER_INDEX, WORKERS, after=after, limit=WEBHOOK_QUEUE_INFLIGHT):
+                after = rows[-1][0]
+                for seq, update_id, key, body in rows:
+                    if seq in inflight:
+                        continue
+                    if key in full:
+                        retry_from = min(retry_from or seq, seq)
+                        continue
+                    if (update := parse_update(application, body)) is None:
+                        WebhookQueue.done(seq)
+                        continue
+                    await slots.acquire()
+                    if reading.done():
+                        slots.release()
+                        return  # stopping, whatever is left stays queued for the next run
+                    if not admits(update):
+                        full.add(key)
+                        retry_from = min(retry_from or seq, seq)
+                        slots.release()
+                        continue
+                    last_seq = max(last_seq, seq)
+                    inflight.add(seq)
+                    application.create_task(handle(seq, update), update=update, name=f"WebhookQueue.{update_id}")
+                    await asyncio.sleep(0)  # lets it reach the scheduler, so the next admits() counts it
+                    dispatched += 1
+            if not dispatched:
+                await wakeup.wait()
+    finally:
+        reading.cancel()
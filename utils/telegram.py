@@ -1,19 +1,26 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import html
 from functools import cached_property
+from pathlib import Path
 from typing import Generator, TYPE_CHECKING
-from uuid import uuid4
 
-from telegram import InlineQueryResultMpeg4Gif, InlineQueryResultPhoto, InlineQueryResultVideo, InputMediaPhoto, \
-    InputMediaVideo
+from telegram import InlineQueryResultCachedMpeg4Gif, InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo, \
+    InlineQueryResultMpeg4Gif, InlineQueryResultPhoto, InlineQueryResultVideo, InputFile, InputMediaDocument, \
+    InputMediaPhoto, InputMediaVideo
 
 from common import PIXIV_REFRESH_TOKEN
-from .bsky import ProcessBsky
+from .bsky import ProcessBsky, ProcessBskyVideo
+from .fileid import FileIdCache
 from .logger import get_logger
-from .pixiv import ProcessPixiv
+from .pixiv import ProcessPixiv, ProcessUgoira, pixiv_headers
 from .regex import bsky_url, pixiv_url, x_url
+from .trace import set_attribute, span
 from .tweet import ProcessTweet
+from .upload import stream_file
+from .variant import VariantSelector
 
 if TYPE_CHECKING:
     from .types import TypeInlineQueryResult, TypeMessageMediaResult
@@ -29,19 +36,34 @@ message_raw_text_pixiv = """<a href="{url}">{text}</a> / <a href="{author_url}">
 """
 
 
+def photo_source(photo: str | Path) -> str | InputFile:
+    if isinstance(photo, Path):
+        return stream_file(photo)
+    return FileIdCache.get(photo, "photo") or photo
+
+
+def result_id(url: str, index: int) -> str:
+    return hashlib.md5(f"{url}#{index}".encode()).hexdigest()
+
+
 class Telegram:
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False, prepare_media: bool = True):
         self._url = url
+        self._refresh = refresh
+        self._prepare_media = prepare_media
 
     async def __aenter__(self):
         if x_url.match(self._url):
-            async with TelegramTweet(self._url) as tweet:
+            set_attribute('provider', 'tweet')
+            async with TelegramTweet(self._url, self._refresh, self._prepare_media) as tweet:
                 return tweet
         elif PIXIV_REFRESH_TOKEN and pixiv_url.match(self._url):
-            async with TelegramPixiv(self._url) as pixiv:
+            set_attribute('provider', 'pixiv')
+            async with TelegramPixiv(self._url, self._refresh, self._prepare_media) as pixiv:
                 return pixiv
         elif bsky_url.match(self._url):
-            async with TelegramBsky(self._url) as bsky:
+            set_attribute('provider', 'bsky')
+            async with TelegramBsky(self._url, self._refresh, self._prepare_media) as bsky:
                 return bsky
         else:
             return None  # TODO add raise and catch
@@ -52,15 +74,24 @@ class Telegram:
 
 class TelegramTweet:
     message_raw_text = message_raw_text_tweet
-    __slots__ = ('_url', '_tweet', '__dict__')
+    __slots__ = ('_url', '_refresh', '_prepare_media', '_tweet', '_photos', '__dict__')
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False, prepare_media: bool = True):
         self._url: str = url
+        self._refresh: bool = refresh
+        self._prepare_media: bool = prepare_media
+        self._photos: dict[str, str | Path] = {}
 
     async def __aenter__(self):
-        async with ProcessTweet(self._url) as tweet:
-            self._tweet = tweet
-            return self
+        with span('fetch', provider='tweet', url=self._url):
+            async with ProcessTweet(self._url, self._refresh) as tweet:
+                self._tweet = tweet
+        if self._prepare_media:
+            with span('render', provider='tweet', url=self._url):
+                images = [i for i in tweet.media if i.type == "image"]
+                variants = await asyncio.gather(*(VariantSelector.photo(i.candidates) for i in images))
+                self._photos = {i.url: variant for i, variant in zip(images, variants)}
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
@@ -79,6 +110,9 @@ class TelegramTweet:
             text=html.escape(tweet.text)
         )
 
+    def original_documents(self) -> tuple[InputMediaDocument, ...]:
+        return tuple(InputMediaDocument(i.candidates[0]) for i in self._tweet.media if i.type == "image")
+
     def inline_query_result(self) -> tuple[TypeInlineQueryResult, ...]:
         return tuple(self.inline_query_generator())
 
@@ -87,18 +121,33 @@ class TelegramTweet:
 
     def inline_query_generator(self) -> Generator[TypeInlineQueryResult, None, None]:
         tweet = self._tweet
-        for tweet_media in tweet.media:
-            logger.info(str(tweet_media))
+        for index, tweet_media in enumerate(tweet.media):
+            logger.debug("%s", tweet_media)
             if tweet_media.type == "image":
+                if cached := VariantSelector.cached_photo(tweet_media.candidates):
+                    yield InlineQueryResultCachedPhoto(
+                        id=result_id(tweet.url, index),
+                        photo_file_id=cached[1],
+                        caption=self.message_text
+                    )
+                    continue
                 yield InlineQueryResultPhoto(
-                    id=str(uuid4()),
+                    id=result_id(tweet.url, index),
                     photo_url=tweet_media.url,
                     thumbnail_url=tweet_media.thumb,
                     caption=self.message_text
                 )
             elif tweet_media.type == "video":
+                if file_id := FileIdCache.get(tweet_media.url, "video"):
+                    yield InlineQueryResultCachedVideo(
+                        id=result_id(tweet.url, index),
+                        video_file_id=file_id,
+                        title=tweet.text,
+                        caption=self.message_text
+                    )
+                    continue
                 yield InlineQueryResultVideo(
-                    id=str(uuid4()),
+                    id=result_id(tweet.url, index),
                     video_url=tweet_media.url,
                     mime_type="video/mp4",
                     thumbnail_url=tweet_media.thumb,
@@ -106,8 +155,15 @@ class TelegramTweet:
                     caption=self.message_text
                 )
             elif tweet_media.type == "gif":
+                if file_id := FileIdCache.get(tweet_media.url, "animation"):
+                    yield InlineQueryResultCachedMpeg4Gif(
+                        id=result_id(tweet.url, index),
+                        mpeg4_file_id=file_id,
+                        caption=self.message_text
+                    )
+                    continue
                 yield InlineQueryResultMpeg4Gif(
-                    id=str(uuid4()),
+                    id=result_id(tweet.url, index),
                     mpeg4_url=tweet_media.url,
                     thumbnail_url=tweet_media.thumb,
                     caption=self.message_text
@@ -116,23 +172,23 @@ class TelegramTweet:
     def message_media_generator(self) -> Generator[TypeMessageMediaResult, None, None]:
         tweet = self._tweet
         for tweet_media in tweet.media:
-            logger.info(str(tweet_media))
+            logger.debug("%s", tweet_media)
             if tweet_media.type == "image":
                 yield InputMediaPhoto(
-                    media=tweet_media.url,
+                    media=photo_source(self._photos.get(tweet_media.url, tweet_media.url)),
                     has_spoiler=tweet.sensitive
                 )
             elif tweet_media.type == "video":
                 yield InputMediaVideo(
-                    media=tweet_media.url,
+                    media=FileIdCache.get(tweet_media.url, "video") or tweet_media.url,
                     has_spoiler=tweet.sensitive,
                     thumbnail=tweet_media.thumb
                 )
             elif tweet_media.type == "gif":
                 if len(tweet.media) == 1:
-                    yield tweet_media.url, tweet.sensitive
+                    yield FileIdCache.get(tweet_media.url, "animation") or tweet_media.url, tweet.sensitive
                 yield InputMediaVideo(
-                    media=tweet_media.url,
+                    media=FileIdCache.get(tweet_media.url, "video") or tweet_media.url,
                     has_spoiler=tweet.sensitive,
                     thumbnail=tweet_media.thumb
                 )
@@ -140,15 +196,32 @@ class TelegramTweet:
 
 class TelegramPixiv:
     message_raw_text = message_raw_text_pixiv
-    __slots__ = ('_url', '_pixiv')
+    __slots__ = ('_url', '_refresh', '_prepare_media', '_pixiv', '_ugoira', '_photos')
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False, prepare_media: bool = True):
         self._url = url
+        self._refresh = refresh
+        self._prepare_media = prepare_media
+        self._ugoira: str | Path | None = None
+        self._photos: dict[str, str | Path] = {}
 
     async def __aenter__(self):
-        async with ProcessPixiv(self._url) as pixiv:
-            self._pixiv = pixiv
-            return self
+        with span('fetch', provider='pixiv', url=self._url):
+            async with ProcessPixiv(self._url, self._refresh) as pixiv:
+                self._pixiv = pixiv
+        if pixiv.type == "ugoira":
+            self._ugoira = FileIdCache.get(pixiv.url, "animation")
+            if not self._ugoira and self._prepare_media:
+                with span('render', provider='pixiv', url=self._url):
+                    async with ProcessUgoira(pixiv.id) as path:
+                        self._ugoira = FileIdCache.local_file(path, pixiv.url)
+        elif self._prepare_media:
+            with span('render', provider='pixiv', url=self._url):
+                variants = await asyncio.gather(
+                    *(VariantSelector.photo(i.candidates, pixiv_headers) for i in pixiv.images)
+                )
+                self._photos = {i.url: variant for i, variant in zip(pixiv.images, variants)}
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
@@ -168,6 +241,11 @@ class TelegramPixiv:
             tags=html.escape(" ".join(f"#{name}" for name in pixiv.tags))
         )
 
+    def original_documents(self) -> tuple[InputMediaDocument, ...]:
+        if self._pixiv.type not in ("illust", "manga"):
+            return ()
+        return tuple(InputMediaDocument(i.url) for i in self._pixiv.images)
+
     def inline_query_result(self) -> tuple[TypeInlineQueryResult, ...]:
         return tuple(i for i in self.inline_query_generator() if i)
 
@@ -176,42 +254,76 @@ class TelegramPixiv:
 
     def inline_query_generator(self) -> Generator[TypeInlineQueryResult, None, None]:
         pixiv = self._pixiv
-        for media in pixiv.images:
-            logger.info(str(media))
+        for index, media in enumerate(pixiv.images):
+            logger.debug("%s", media)
             if pixiv.type in ("illust", "manga"):
+                if cached := VariantSelector.cached_photo(media.candidates):
+                    yield InlineQueryResultCachedPhoto(
+                        id=result_id(pixiv.url, index),
+                        photo_file_id=cached[1],
+                        caption=self.message_text
+                    )
+                    continue
                 yield InlineQueryResultPhoto(
-                    id=str(uuid4()),
+                    id=result_id(pixiv.url, index),
                     photo_url=media.large,
                     thumbnail_url=media.thumb,
                     caption=self.message_text
                 )
+            elif pixiv.type == "ugoira" and (file_id := FileIdCache.get(pixiv.url, "animation")):
+                yield InlineQueryResultCachedMpeg4Gif(
+                    id=result_id(pixiv.url, index),
+                    mpeg4_file_id=file_id,
+                    caption=self.message_text
+                )
             else:
                 yield
 
     def message_media_generator(self) -> Generator[TypeMessageMediaResult, None, None]:
         pixiv = self._pixiv
         for media in pixiv.images:
-            logger.info(str(media))
+            logger.debug("%s", media)
             if pixiv.type in ("illust", "manga"):
                 yield InputMediaPhoto(
-                    media=media.large,
+                    media=photo_source(self._photos.get(media.url, media.large)),
                     has_spoiler=pixiv.is_nsfw
                 )
+            elif pixiv.type == "ugoira" and self._ugoira:
+                yield self._ugoira, pixiv.is_nsfw
             else:
                 yield
 
 
 class TelegramBsky:
     message_raw_text = message_raw_text_tweet
-    __slots__ = ('_url', '_bsky', '__dict__')
+    __slots__ = ('_url', '_refresh', '_prepare_media', '_bsky', '_videos', '_photos', '__dict__')
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False, prepare_media: bool = True):
         self._url: str = url
+        self._refresh: bool = refresh
+        self._prepare_media: bool = prepare_media
+        self._videos: dict[str, str | Path] = {}
+        self._photos: dict[str, str | Path] = {}
 
     async def __aenter__(self):
-        async with ProcessBsky(self._url) as bsky:
-            self._bsky = bsky
-            return self
+        with span('fetch', provider='bsky', url=self._url):
+            async with ProcessBsky(self._url, self._refresh) as bsky:
+                self._bsky = bsky
+        for bsky_media in bsky.media:
+            if bsky_media.type != "video":
+                continue
+            if file_id := FileIdCache.get(bsky_media.url, "video"):
+                self._videos[bsky_media.url] = file_id
+            elif self._prepare_media:
+                with span('render', provider='bsky', url=self._url):
+                    async with ProcessBskyVideo(bsky_media.url) as path:
+                        self._videos[bsky_media.url] = FileIdCache.local_file(path, bsky_media.url)
+        if self._prepare_media:
+            with span('render', provider='bsky', url=self._url):
+                images = [i.url for i in bsky.media if i.type == "image"]
+                variants = await asyncio.gather(*(VariantSelector.photo([i]) for i in images))
+                self._photos = dict(zip(images, variants))
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
@@ -230,6 +342,9 @@ class TelegramBsky:
             text=html.escape(bsky.text)
         )
 
+    def original_documents(self) -> tuple[InputMediaDocument, ...]:
+        return tuple(InputMediaDocument(i.url) for i in self._bsky.media if i.type == "image")
+
     def inline_query_result(self) -> tuple[TypeInlineQueryResult, ...]:
         return tuple(i for i in self.inline_query_generator() if i)
 
@@ -238,28 +353,35 @@ class TelegramBsky:
 
     def inline_query_generator(self) -> Generator[TypeInlineQueryResult, None, None]:
         bsky = self._bsky
-        for bsky_media in bsky.media:
-            logger.info(str(bsky_media))
+        for index, bsky_media in enumerate(bsky.media):
+            logger.debug("%s", bsky_media)
             if bsky_media.type == "image":
+                if file_id := FileIdCache.get(bsky_media.url, "photo"):
+                    yield InlineQueryResultCachedPhoto(
+                        id=result_id(bsky.url, index),
+                        photo_file_id=file_id,
+                        caption=self.message_text
+                    )
+                    continue
                 yield InlineQueryResultPhoto(
-                    id=str(uuid4()),
+                    id=result_id(bsky.url, index),
                     photo_url=bsky_media.url,
                     thumbnail_url=bsky_media.thumb,
                     caption=self.message_text
                 )
             elif bsky_media.type == "video":
-                # yield InlineQueryResultVideo(
-                #     id=str(uuid4()),
-                #     video_url=bsky_media.url,
-                #     mime_type="video/mp4",
-                #     thumbnail_url=bsky_media.thumb,
-                #     title=bsky.text,
-                #     caption=self.message_text
-                # )
+                if file_id := FileIdCache.get(bsky_media.url, "video"):
+                    yield InlineQueryResultCachedVideo(
+                        id=result_id(bsky.url, index),
+                        video_file_id=file_id,
+                        title=bsky.text or "Bluesky video",
+                        caption=self.message_text
+                    )
+                    continue
                 yield
             elif bsky_media.type == "external":
                 # yield InlineQueryResultVideo(
-                #     id=str(uuid4()),
+                #     id=result_id(bsky.url, index),
                 #     video_url=bsky_media.url,
                 #     mime_type="image/gif",
                 #     thumbnail_url=bsky_media.thumb,
@@ -271,18 +393,19 @@ class TelegramBsky:
     def message_media_generator(self) -> Generator[TypeMessageMediaResult, None, None]:
         bsky = self._bsky
         for bsky_media in bsky.media:
-            logger.info(str(bsky_media))
+            logger.debug("%s", bsky_media)
             if bsky_media.type == "image":
                 yield InputMediaPhoto(
-                    media=bsky_media.url,
+                    media=photo_source(self._photos.get(bsky_media.url, bsky_media.url)),
                     has_spoiler=bsky.sensitive
                 )
+            elif bsky_media.type == "video" and (video := self._videos.get(bsky_media.url)):
+                yield InputMediaVideo(
+                    media=stream_file(video) if isinstance(video, Path) else video,
+                    has_spoiler=bsky.sensitive,
+                    supports_streaming=True
+                )
             elif bsky_media.type == "video":
-                # yield InputMediaVideo(
-                #     media=bsky_media.url,
-                #     has_spoiler=bsky.sensitive,
-                #     thumbnail=bsky_media.thumb
-                # )
                 yield
             elif bsky_media.type == "external":
-                yield bsky_media.url, bsky.sensitive
+                yield FileIdCache.get(bsky_media.url, "animation") or bsky_media.url, bsky.sensitive
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Awaitable, Callable, Iterator, TYPE_CHECKING
+
+from common import TRACE_EXPORT, TRACE_FILE, TRACE_OTLP_ENDPOINT
+from .logger import get_logger
+from .net import NetClient
+
+if TYPE_CHECKING:
+    from telegram import Update
+
+logger = get_logger(__name__)
+
+_current: ContextVar[Trace | None] = ContextVar('trace', default=None)
+_parent: ContextVar[Span | None] = ContextVar('span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'span_id', 'parent_id', 'start', 'end', 'attributes')
+
+    def __init__(self, name: str, attributes: dict[str, Any], parent: Span | None = None):
+        self.name: str = name
+        self.span_id: str = os.urandom(8).hex()
+        self.parent_id: str = parent.span_id if parent else ''
+        self.start: int = time.time_ns()
+        self.end: int = 0
+        self.attributes: dict[str, Any] = attributes
+
+    @property
+    def duration(self) -> float:
+        return (self.end - self.start) / 1e9
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            **self.attributes
+        }
+
+
+class Trace:
+    __slots__ = ('trace_id', 'root', 'spans')
+
+    def __init__(self, name: str, attributes: dict[str, Any]):
+        self.trace_id: str = os.urandom(16).hex()
+        self.root: Span = Span(name, attributes)
+        self.spans: list[Span] = []
+
+    def __str__(self):
+        stages = ", ".join(f"{span.name}={span.duration:.3f}s" for span in self.spans)
+        return f"Trace({self.root.name}, {self.root.duration:.3f}s, {self.root.attributes}, {stages})"
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            **self.root.to_dict(),
+            'spans': [span.to_dict() for span in self.spans],
+        }
+
+
+def set_attribute(key: str, value: Any) -> None:
+    if (trace := _current.get()) is not None:
+        trace.root.attributes[key] = value
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    if (trace := _current.get()) is None:
+        yield
+        return
+    item = Span(name, attributes, _parent.get() or trace.root)
+    token = _parent.set(item)
+    try:
+        yield
+    except BaseException as e:
+        item.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        item.end = time.time_ns()
+        _parent.reset(token)
+        trace.spans.append(item)
+
+
+def trace_handler(callback: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @wraps(callback)
+    async def traced(update: Update, *args, **kwargs):
+        trace = Trace(callback.__name__, {
+            'update_id': update.update_id,
+            'chat_id': update.effective_chat.id if update.effective_chat else None,
+        })
+        token = _current.set(trace)
+        try:
+            return await callback(update, *args, **kwargs)
+        except BaseException as e:
+            trace.root.attributes['error'] = type(e).__name__
+            raise
+        finally:
+            trace.root.end = time.time_ns()
+            _current.reset(token)
+            Tracer.export(trace)
+
+    return traced
+
+
+def otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(trace: Trace, item: Span) -> dict[str, Any]:
+    return {
+        'traceId': trace.trace_id,
+        'spanId': item.span_id,
+        'parentSpanId': item.parent_id,
+        'name': item.name,
+        'kind': 1,
+        'startTimeUnixNano': str(item.start),
+        'endTimeUnixNano': str(item.end),
+        'attributes': [{'key': k, 'value': otlp_value(v)} for k, v in item.attributes.items() if v is not None],
+    }
+
+
+def append_lines(path: str, lines: list[str]) -> None:
+    with open(path, 'a') as file:
+        file.writelines(lines)
+
+
+class Tracer:
+    _tasks: set[asyncio.Task] = set()
+    _lines: list[str] = []
+    _writer: asyncio.Task | None = None
+
+    @classmethod
+    def export(cls, trace: Trace) -> None:
+        logger.debug("%s", trace)
+        if TRACE_EXPORT == 'jsonl':
+            # one writer thread at a time keeps the file in order, traces queue up while it writes
+            cls._lines.append(json.dumps(trace.to_dict()) + '\n')
+            if cls._writer is None:
+                cls._writer = asyncio.create_task(cls._write_jsonl(), name="Tracer.write_jsonl")
+        elif TRACE_EXPORT == 'otlp':
+            task = asyncio.create_task(cls._post_otlp(trace))
+            cls._tasks.add(task)
+            task.add_done_callback(cls._tasks.discard)
+
+    @classmethod
+    async def _write_jsonl(cls) -> None:
+        try:
+            while cls._lines:
+                lines, cls._lines = cls._lines, []
+                try:
+                    await asyncio.to_thread(append_lines, TRACE_FILE, lines)
+                except OSError as e:
+                    logger.debug("Failed to write %d traces: %r", len(lines), e)
+        finally:
+            cls._writer = None
+
+    @classmethod
+    async def flush(cls) -> None:
+        await asyncio.gather(*cls._tasks, *([cls._writer] if cls._writer else []), return_exceptions=True)
+
+    @classmethod
+    async def _post_otlp(cls, trace: Trace) -> None:
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': otlp_value('telegram-media-bot')}]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [
+                    otlp_span(trace, trace.root),
+                    *(otlp_span(trace, item) for item in trace.spans),
+                ],
+            }],
+        }]}
+        try:
+            response = await NetClient.get_client().post(TRACE_OTLP_ENDPOINT, json=body)
+            response.raise_for_status()
+        except Exception as e:
+            logger.debug("Failed to export trace %s: %r", trace.trace_id, e)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from PIL import Image, ImageOps
+
+from common import TRANSCODE_QUEUE, TRANSCODE_WORKERS
+
+Image.MAX_IMAGE_PIXELS = 1 << 28  # pixiv originals go well beyond Pillow's default bomb check
+
+T = TypeVar('T')
+
+
+class TranscodeBusyError(Exception):
+    pass
+
+
+def ffmpeg(*args: str, cwd: str | None = None) -> None:
+    subprocess.run(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', *args], check=True, cwd=cwd)
+
+
+def ugoira_to_mp4(zip_path: str, frames: list[tuple[str, int]], output: str) -> str:
+    with tempfile.TemporaryDirectory() as tmp:
+        with zipfile.ZipFile(zip_path) as archive:
+            archive.extractall(tmp)
+        with open(os.path.join(tmp, 'frames.txt'), 'w') as concat:
+            concat.write('ffconcat version 1.0\n')
+            for name, delay in frames:
+                concat.write(f"file '{name}'\nduration {delay / 1000}\n")
+            concat.write(f"file '{frames[-1][0]}'\n")  # concat demuxer drops the last duration otherwise
+        part = f"{output}.part"
+        ffmpeg(
+            '-f', 'concat', '-safe', '0', '-i', 'frames.txt',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart', '-f', 'mp4', part,
+            cwd=tmp
+        )
+        os.replace(part, output)
+    return output
+
+
+def ts_to_mp4(input: str, output: str) -> str:
+    part = f"{output}.part"
+    ffmpeg(
+        '-i', input, '-c', 'copy', '-bsf:a', 'aac_adtstoasc',
+        '-movflags', '+faststart', '-f', 'mp4', part
+    )
+    os.replace(part, output)
+    return output
+
+
+def shrink_image(input: str, output: str, max_bytes: int, max_dimensions: int) -> str:
+    with Image.open(input) as image:
+        scale = min(1.0, max_dimensions / (image.width + image.height))
+        # let the JPEG decoder skip detail we would throw away anyway
+        image.draft('RGB', (int(image.width * scale), int(image.height * scale)))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+    scale = min(1.0, max_dimensions / (image.width + image.height))
+    quality = 90
+    while True:
+        if scale < 1:
+            size = (int(image.width * scale), int(image.height * scale))
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality)
+        if buffer.tell() <= max_bytes:
+            break
+        if quality > 80:
+            quality -= 10
+            scale = 1.0
+        else:
+            # bytes grow with the pixel count, aim a bit below the limit in one step
+            scale = (max_bytes / buffer.tell()) ** 0.5 * 0.95
+    part = f"{output}.part"
+    with open(part, 'wb') as file:
+        file.write(buffer.getbuffer())
+    os.replace(part, output)
+    return output
+
+
+class Transcoder:
+    _pool: ProcessPoolExecutor | None = None
+    _limit: int = TRANSCODE_WORKERS + TRANSCODE_QUEUE
+    _pending: int = 0
+
+    @classmethod
+    def init_pool(cls, workers: int = TRANSCODE_WORKERS, queue: int = TRANSCODE_QUEUE) -> None:
+        # spawn, not fork: the bot process already runs threads (persistence, sqlite)
+        cls._pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        cls._limit = workers + queue
+
+    @classmethod
+    def close_pool(cls) -> None:
+        if cls._pool is not None:
+            cls._pool.shutdown(wait=False, cancel_futures=True)
+            cls._pool = None
+
+    @classmethod
+    def pending(cls) -> int:
+        return cls._pending
+
+    @classmethod
+    async def run(cls, func: Callable[..., T], *args: Any) -> T:
+        if cls._pool is None:
+            cls.init_pool()
+        if cls._pending >= cls._limit:
+            raise TranscodeBusyError("Too many media jobs queued, please try again later.")
+        cls._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(cls._pool, func, *args)
+        finally:
+            cls._pending -= 1
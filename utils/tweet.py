@@ -1,16 +1,68 @@
 from __future__ import annotations
 
+import asyncio
 from functools import cached_property
 from typing import TYPE_CHECKING
 
+from common import TWEET_HEDGE_DELAY
+from .cache import PostCache
+from .logger import get_logger
 from .net import NetClient
 from .regex import x_media_url, x_tco_url, x_url
 
 if TYPE_CHECKING:
-    from .types import TweetInfo
+    from .types import FxTweet, TweetInfo
+
+logger = get_logger(__name__)
 
 twimg_url = 'https://pbs.twimg.com/'
 vx_api_url = 'https://api.vxtwitter.com/{0}/status/{1}'
+fx_api_url = 'https://api.fxtwitter.com/{0}/status/{1}'
+
+fx_media_type = {'photo': 'image', 'video': 'video', 'gif': 'gif'}
+
+
+async def fetch_vx_tweet(author_id: str, tweet_id: str) -> TweetInfo:
+    return await NetClient.fetch_json(vx_api_url.format(author_id, tweet_id))
+
+
+async def fetch_fx_tweet(author_id: str, tweet_id: str) -> TweetInfo:
+    tweet: FxTweet = (await NetClient.fetch_json(fx_api_url.format(author_id, tweet_id)))['tweet']
+    return {
+        'tweetID': tweet['id'],
+        'user_name': tweet['author']['name'],
+        'user_screen_name': tweet['author']['screen_name'],
+        'text': tweet['text'],
+        'media_extended': [
+            {
+                'url': media['url'],
+                'thumbnail_url': media.get('thumbnail_url', media['url']),
+                'type': fx_media_type.get(media['type'], media['type'])
+            }
+            for media in (tweet.get('media') or {}).get('all', [])
+        ],
+        'possibly_sensitive': tweet.get('possibly_sensitive', False)
+    }
+
+
+async def fetch_tweet_info(author_id: str, tweet_id: str) -> TweetInfo:
+    # vxtwitter first; fxtwitter as a fallback on error, or as a hedge when vxtwitter is slow
+    tasks = [asyncio.ensure_future(fetch_vx_tweet(author_id, tweet_id))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=TWEET_HEDGE_DELAY or None)
+        if not done or tasks[0].exception() is not None:
+            tasks.append(asyncio.ensure_future(fetch_fx_tweet(author_id, tweet_id)))
+        error = None
+        for future in asyncio.as_completed(tasks):
+            try:
+                return await future
+            except Exception as e:
+                logger.warning("Failed to fetch tweet %s: %r", tweet_id, e)
+                error = e
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 class TweetMedia:
@@ -42,6 +94,12 @@ class TweetMedia:
             case _:
                 return self._url
 
+    @cached_property
+    def candidates(self) -> list[str]:
+        if self._type == "image":
+            return [f"{twimg_url}{self._uri}?format=jpg&name={name}" for name in ("orig", "4096x4096", "large")]
+        return [self.url]
+
     @cached_property
     def thumb(self) -> str:
         match self._type:
@@ -108,10 +166,11 @@ class Tweet:
 
 
 class ProcessTweet:
-    __slots__ = ('_url', '_tweet')
+    __slots__ = ('_url', '_refresh', '_tweet')
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, refresh: bool = False):
         self._url: str = url
+        self._refresh: bool = refresh
 
     async def __aenter__(self):
         self._tweet = await self._fetch_tweet()
@@ -131,7 +190,12 @@ class ProcessTweet:
         match = x_url.match(self._url)
         assert match, f"Invalid URL: {self._url}"
         auther_id, tweet_id = match.groups()
-        return await NetClient.fetch_json(vx_api_url.format(auther_id, tweet_id))
+        return await PostCache.fetch(
+            'tweet',
+            tweet_id,
+            lambda: fetch_tweet_info(auther_id, tweet_id),
+            refresh=self._refresh
+        )
 
     @property
     def _tweet_text(self) -> str:
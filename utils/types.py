@@ -1,13 +1,16 @@
 from __future__ import annotations
 
+from pathlib import Path
 from typing import Literal, TypedDict
 
-from telegram import InlineQueryResultMpeg4Gif, InlineQueryResultPhoto, InlineQueryResultVideo, InputMediaPhoto, \
+from telegram import InlineQueryResultCachedMpeg4Gif, InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo, \
+    InlineQueryResultMpeg4Gif, InlineQueryResultPhoto, InlineQueryResultVideo, InputMediaDocument, InputMediaPhoto, \
     InputMediaVideo
 
-TypeInlineQueryResult = InlineQueryResultMpeg4Gif | InlineQueryResultPhoto | InlineQueryResultVideo
-InputMediaAnimation = tuple[str, bool]
-TypeMessageMediaResult = InputMediaPhoto | InputMediaVideo | InputMediaAnimation
+TypeInlineQueryResult = InlineQueryResultMpeg4Gif | InlineQueryResultPhoto | InlineQueryResultVideo | \
+                        InlineQueryResultCachedMpeg4Gif | InlineQueryResultCachedPhoto | InlineQueryResultCachedVideo
+InputMediaAnimation = tuple[str | Path, bool]
+TypeMessageMediaResult = InputMediaPhoto | InputMediaVideo | InputMediaDocument | InputMediaAnimation
 
 
 class TweetInfo(TypedDict):
@@ -19,6 +22,29 @@ class TweetInfo(TypedDict):
     possibly_sensitive: bool
 
 
+class FxAuthor(TypedDict):
+    name: str
+    screen_name: str
+
+
+class FxMedia(TypedDict):
+    type: Literal['photo', 'video', 'gif']
+    url: str
+    thumbnail_url: str
+
+
+class FxMediaList(TypedDict):
+    all: list[FxMedia]
+
+
+class FxTweet(TypedDict):
+    id: str
+    text: str
+    author: FxAuthor
+    media: FxMediaList
+    possibly_sensitive: bool
+
+
 class BskyInfo(TypedDict):
     thread: BskyThread
 
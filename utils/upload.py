@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Sequence, TYPE_CHECKING
+
+from httpx import URL
+from telegram import InputFile, InputMedia, InputMediaDocument, InputMediaPhoto
+
+from common import UPLOAD_HOST_THRESHOLD, UPLOAD_HOST_TTL, UPLOAD_ROUTE_SIZE, UPLOAD_ROUTE_TTL
+from .cache import TTLCache
+from .fileid import FileIdCache
+from .logger import get_logger
+from .media import MediaCache
+from .pixiv import pixiv_headers
+
+if TYPE_CHECKING:
+    from telegram.error import BadRequest
+
+    from .types import TypeMessageMediaResult
+
+logger = get_logger(__name__)
+
+UPLOAD_LIMIT = 50 * 1024 * 1024
+
+# Bot API errors meaning Telegram could not fetch the URL itself, e.g. too large or a missing Referer
+FETCH_ERRORS = ('http url', 'url content', 'web page', 'webpage')
+# Bot API errors for a file_id Telegram no longer accepts
+FILE_ID_ERRORS = ('file identifier', 'file reference', 'file_reference')
+
+UPLOAD_HEADERS = {
+    'i.pximg.net': pixiv_headers,
+}
+
+
+def stream_file(path: Path, attach: bool = True) -> InputFile:
+    # hand httpx the open file so the multipart body is streamed instead of read into memory,
+    # MediaUpload closes it once the media is sent
+    return InputFile(open(path, 'rb'), filename=path.name, attach=attach, read_file_handle=False)
+
+
+def media_suffix(item: InputMedia) -> str:
+    if isinstance(item, InputMediaDocument) and isinstance(item.media, str):
+        return Path(URL(item.media).path).suffix or '.jpg'
+    return '.jpg' if isinstance(item, InputMediaPhoto) else '.mp4'
+
+
+def is_fetch_error(error: BadRequest) -> bool:
+    message = error.message.lower()
+    return any(i in message for i in FETCH_ERRORS)
+
+
+def is_file_id_error(error: BadRequest) -> bool:
+    message = error.message.lower()
+    return any(i in message for i in FILE_ID_ERRORS)
+
+
+def remote_urls(media: Sequence[TypeMessageMediaResult]) -> list[str]:
+    sources = (item[0] if isinstance(item, tuple) else item.media for item in media)
+    return [i for i in sources if isinstance(i, str) and i.startswith('http')]
+
+
+class UploadRoute:
+    _urls: TTLCache[str, bool] = TTLCache(UPLOAD_ROUTE_SIZE, UPLOAD_ROUTE_TTL)
+    _host_failures: TTLCache[str, int] = TTLCache(UPLOAD_ROUTE_SIZE, UPLOAD_HOST_TTL)
+    _hosts: TTLCache[str, bool] = TTLCache(UPLOAD_ROUTE_SIZE, UPLOAD_HOST_TTL)
+
+    @classmethod
+    def needs_upload(cls, url: str) -> bool:
+        return URL(url).host in cls._hosts or url in cls._urls
+
+    @classmethod
+    def failed(cls, urls: Sequence[str]) -> None:
+        # one failure per host and message, a single album must not flag its host
+        for url in urls:
+            cls._urls.set(url, True)
+        for host in {URL(url).host for url in urls}:
+            failures = cls._host_failures.get(host, 0) + 1
+            cls._host_failures.set(host, failures)
+            if failures >= UPLOAD_HOST_THRESHOLD and host not in cls._hosts:
+                logger.warning("Telegram keeps failing to fetch from %s, upload its media for %ss", host,
+                               UPLOAD_HOST_TTL)
+                cls._hosts.set(host, True)
+                cls._host_failures.pop(host)
+
+    @classmethod
+    def succeeded(cls, urls: Sequence[str]) -> None:
+        for url in urls:
+            cls._host_failures.pop(URL(url).host)
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        cls._hosts.expire()
+        return {
+            'urls': len(cls._urls),
+            'hosts': len(cls._hosts),
+        }
+
+
+class MediaUpload:
+    __slots__ = ('_stack',)
+
+    def __init__(self):
+        self._stack: ExitStack = ExitStack()
+
+    def __enter__(self) -> MediaUpload:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stack.close()
+
+    def open(self, path: Path, attach: bool) -> InputFile:
+        return self._own(stream_file(path, attach))
+
+    def _own(self, source: InputFile) -> InputFile:
+        if not isinstance(source.input_file_content, bytes):
+            self._stack.callback(source.input_file_content.close)
+        return source
+
+    async def fetch(self, url: str, suffix: str) -> Path:
+        path = await MediaCache.fetch(url, suffix, headers=UPLOAD_HEADERS.get(URL(url).host), max_size=UPLOAD_LIMIT)
+        return FileIdCache.local_file(path, url)
+
+    async def prepare(
+            self,
+            media: Sequence[TypeMessageMediaResult],
+            upload_urls: bool = False
+    ) -> list[TypeMessageMediaResult]:
+        return list(await asyncio.gather(*(self._prepare(item, upload_urls) for item in media)))
+
+    async def _prepare(self, item: TypeMessageMediaResult, upload_urls: bool) -> TypeMessageMediaResult:
+        if isinstance(item, tuple):
+            return await self._input(item[0], '.mp4', False, upload_urls), item[1]
+        source = await self._input(item.media, media_suffix(item), True, upload_urls)
+        if source is not item.media:
+            with item._unfrozen():
+                item.media = source
+        return item
+
+    async def _input(
+            self,
+            source: str | Path | InputFile,
+            suffix: str,
+            attach: bool,
+            upload_urls: bool
+    ) -> str | InputFile:
+        if isinstance(source, InputFile):
+            if not isinstance(source.input_file_content, bytes):
+                source.input_file_content.seek(0)  # a failed attempt may already have read it
+                self._own(source)
+            return source
+        if isinstance(source, Path):
+            return self.open(source, attach)
+        if source.startswith('http') and (upload_urls or UploadRoute.needs_upload(source)):
+            return self.open(await self.fetch(source, suffix), attach)
+        return source
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import struct
+from pathlib import Path
+from typing import NamedTuple, Sequence
+
+from httpx import HTTPError, URL
+
+from common import VARIANT_CACHE_SIZE, VARIANT_CACHE_TTL
+from .cache import SingleFlight, TTLCache
+from .fileid import FileIdCache
+from .logger import get_logger
+from .media import MediaCache
+from .net import NetClient
+from .transcode import Transcoder, shrink_image
+
+logger = get_logger(__name__)
+
+PHOTO_MAX_SIZE = 10 * 1024 * 1024
+PHOTO_MAX_DIMENSIONS = 10000  # width + height
+PHOTO_MAX_RATIO = 20
+PHOTO_SOURCE_LIMIT = 64 * 1024 * 1024
+PROBE_BYTES = 1 << 16
+
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class Variant(NamedTuple):
+    size: int
+    width: int | None
+    height: int | None
+
+    @property
+    def fits_photo(self) -> bool:
+        if self.size > PHOTO_MAX_SIZE:
+            return False
+        if self.width is None or self.height is None:
+            return True  # dimensions are not in the probed bytes, let Telegram decide
+        return (self.width + self.height <= PHOTO_MAX_DIMENSIONS
+                and max(self.width, self.height) <= PHOTO_MAX_RATIO * min(self.width, self.height))
+
+
+def image_dimensions(data: bytes) -> tuple[int, int] | None:
+    if data.startswith(b'\x89PNG\r\n\x1a\n') and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if not data.startswith(b'\xff\xd8'):
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker in JPEG_SOF:
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return None
+
+
+def content_size(headers) -> int | None:
+    if content_range := headers.get('content-range'):
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    if content_length := headers.get('content-length'):
+        return int(content_length)
+    return None
+
+
+class VariantSelector:
+    _variants: TTLCache[str, Variant | None] = TTLCache(VARIANT_CACHE_SIZE, VARIANT_CACHE_TTL)
+    _flights: SingleFlight[str, Variant | None] = SingleFlight()
+
+    @classmethod
+    async def probe(cls, url: str, headers: dict = None) -> Variant | None:
+        if url in cls._variants:
+            return cls._variants.get(url)
+        return await cls._flights.do(url, lambda: cls._probe(url, headers))
+
+    @classmethod
+    async def _probe(cls, url: str, headers: dict | None) -> Variant | None:
+        # a ranged GET answers size and dimensions in one round trip, where HEAD would only give the size
+        client = NetClient.get_client()
+        try:
+            async with NetClient.host_limit(url):
+                async with client.stream(
+                        'GET', url, headers={**(headers or {}), 'Range': f'bytes=0-{PROBE_BYTES - 1}'}
+                ) as response:
+                    if not response.is_success:
+                        variant = None
+                    else:
+                        data = b''
+                        async for chunk in response.aiter_bytes():
+                            data += chunk
+                            if len(data) >= PROBE_BYTES:
+                                break
+                        size = content_size(response.headers)
+                        dimensions = image_dimensions(data) or (None, None)
+                        variant = Variant(size, *dimensions) if size is not None else None
+        except HTTPError as e:
+            logger.info("Failed to probe %s: %r", url, e)
+            return None  # don't cache, the next probe may succeed
+        cls._variants.set(url, variant)
+        return variant
+
+    @classmethod
+    async def best_photo(cls, candidates: Sequence[str], headers: dict = None) -> str | None:
+        if cached := cls.cached_photo(candidates):
+            return cached[0]
+        variants = await asyncio.gather(*(cls.probe(url, headers) for url in candidates))
+        if all(variant is None for variant in variants):
+            return candidates[-1]  # nothing known about the variants, let Telegram try the smallest
+        original = variants[0]
+        for url, variant in zip(candidates, variants):
+            if variant is None or not variant.fits_photo:
+                continue
+            if original is None or original.width is None or variant[1:] == original[1:]:
+                return url
+        # smaller variants lose resolution, the original shrunk to the limits keeps more of it
+        return None
+
+    @classmethod
+    async def photo(cls, candidates: Sequence[str], headers: dict = None) -> str | Path:
+        if (url := await cls.best_photo(candidates, headers)) is not None:
+            return url
+        try:
+            async with ProcessPhoto(candidates[0], headers) as path:
+                return FileIdCache.local_file(path, candidates[0])
+        except Exception as e:
+            # pool busy, source too large or unreadable: a smaller variant still beats failing the post
+            logger.warning("Failed to shrink %s, sending a smaller variant: %r", candidates[0], e)
+            return cls.fitting_photo(candidates)
+
+    @classmethod
+    def fitting_photo(cls, candidates: Sequence[str]) -> str:
+        for url in candidates[1:]:
+            if (variant := cls._variants.get(url)) is not None and variant.fits_photo:
+                return url
+        return candidates[-1]
+
+    @staticmethod
+    def cached_photo(candidates: Sequence[str]) -> tuple[str, str] | None:
+        for url in candidates:
+            if file_id := FileIdCache.get(url, "photo"):
+                return url, file_id
+        return None
+
+
+class ProcessPhoto:
+    __slots__ = ('_url', '_headers')
+
+    def __init__(self, url: str, headers: dict = None):
+        self._url: str = url
+        self._headers: dict | None = headers
+
+    async def __aenter__(self) -> Path:
+        return await MediaCache.render(f'photo:{self._url}', '.jpg', self._render)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def _render(self, output: str) -> None:
+        source = await MediaCache.fetch(
+            self._url,
+            Path(URL(self._url).path).suffix,
+            headers=self._headers,
+            max_size=PHOTO_SOURCE_LIMIT
+        )
+        logger.info("Shrink %s to fit Telegram photo limits", self._url)
+        await Transcoder.run(shrink_image, str(source), output, PHOTO_MAX_SIZE, PHOTO_MAX_DIMENSIONS)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import sqlite3
+import time
+
+from common import WEBHOOK_QUEUE_DB, WEBHOOK_QUEUE_RETENTION
+from .db import connect_sqlite
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Raw webhook updates, in the order they arrived. update_id is unique, so an update Telegram delivers again
+# is ignored; rows are marked done once handled and kept for WEBHOOK_QUEUE_RETENTION seconds to catch late
+# redeliveries. WAL with synchronous=NORMAL survives process crashes and restarts, not power loss.
+class WebhookQueue:
+    _db: sqlite3.Connection | None = None
+
+    @classmethod
+    def init_db(cls, path: str = WEBHOOK_QUEUE_DB) -> None:
+        cls._db = connect_sqlite(path)
+        cls._db.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_update ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, update_id INTEGER NOT NULL UNIQUE, key INTEGER NOT NULL, "
+            "body BLOB NOT NULL, received REAL NOT NULL, done REAL)"
+        )
+        cls._db.execute("CREATE INDEX IF NOT EXISTS webhook_update_pending ON webhook_update (seq) WHERE done IS NULL")
+        cls._db.execute("CREATE INDEX IF NOT EXISTS webhook_update_done ON webhook_update (done)")
+
+    @classmethod
+    def close_db(cls) -> None:
+        if cls._db is not None:
+            cls._db.close()
+            cls._db = None
+
+    @classmethod
+    def append(cls, update_id: int, key: int, body: bytes) -> bool:
+        cursor = cls._db.execute(
+            "INSERT OR IGNORE INTO webhook_update (update_id, key, body, received) VALUES (?, ?, ?, ?)",
+            (update_id, key, body, time.time())
+        )
+        return cursor.rowcount > 0
+
+    @classmethod
+    def pending(cls, shard: int, shards: int, after: int = 0, limit: int = 100) -> list[tuple[int, int, int, bytes]]:
+        # sqlite's % keeps the sign of the key, python's shard_of doesn't
+        return cls._db.execute(
+            "SELECT seq, update_id, key, body FROM webhook_update "
+            "WHERE done IS NULL AND seq > ? AND ((key % ?) + ?) % ? = ? ORDER BY seq LIMIT ?",
+            (after, shards, shards, shards, shard, limit)
+        ).fetchall()
+
+    @classmethod
+    def done(cls, seq: int) -> None:
+        cls._db.execute("UPDATE webhook_update SET done = ? WHERE seq = ?", (time.time(), seq))
+
+    @classmethod
+    def backlog(cls) -> int:
+        return cls._db.execute("SELECT COUNT(*) FROM webhook_update WHERE done IS NULL").fetchone()[0]
+
+    @classmethod
+    def purge(cls, retention: float = WEBHOOK_QUEUE_RETENTION) -> int:
+        deleted = cls._db.execute("DELETE FROM webhook_update WHERE done < ?", (time.time() - retention,)).rowcount
+        if deleted:
+            logger.info("Purged %d handled webhook updates", deleted)
+        return deleted